@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) Canux CHENG <canuxcheng@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Benchmark ``fleet.command`` on many loopback hosts.
+
+``--hosts`` loopback hosts (see :mod:`loopback`) are split in the
+``workers`` and ``satellites`` roles, and a command sleeping ``--latency``
+seconds (the round-trip of a real host) is run on all of them at most
+``--pool`` at once. The wall time is compared to the sum of the time spent
+on each host, which is what running them one by one would take.
+
+Usage::
+
+    python benchmarks/fleet.py [--hosts N] [--pool N] [--latency SECONDS]
+"""
+
+import argparse
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import loopback
+
+# The repository package, its tasks package would hide the tasks module of
+# the installed Fabric: the modules used by fleet.py are loaded alone.
+REPOSITORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'fabric')
+
+
+def load_fleet():
+    """Load fleet.py and the repository modules it uses along Fabric."""
+    import fabric
+    for name in ('git', 'trace', 'helpers'):
+        setattr(fabric, name, imp.load_source(
+            'fabric.{}'.format(name), os.path.join(REPOSITORY,
+                                                   '{}.py'.format(name))))
+    return imp.load_source('fleet', os.path.join(REPOSITORY, 'tasks',
+                                                 'fleet.py'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hosts', type=int, default=1000,
+                        help='number of hosts (default: 1000)')
+    parser.add_argument('--pool', type=int, default=100,
+                        help='hosts handled at once (default: 100)')
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='seconds spent on each host (default: 0.1)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='zfabric-fleet-')
+    try:
+        hosts = ['host-{}'.format(i + 1) for i in range(args.hosts)]
+        for host in hosts:
+            os.makedirs(os.path.join(workdir, host))
+        loopback.install(workdir)
+
+        from fabric.api import env, hide
+        fleet = load_fleet()
+
+        half = len(hosts) // 2
+        env.roledefs.update({'workers': hosts[:half],
+                             'satellites': hosts[half:]})
+
+        start = time.time()
+        with hide('everything'):
+            results = fleet.command(
+                'sleep {}; uname -s'.format(args.latency),
+                roles='workers;satellites', pool_size=args.pool,
+                stream=False)
+        wall_time = time.time() - start
+
+        serial_time = sum(result['duration'] for result in results)
+        failed = len([result for result in results
+                      if result['status'] != 'ok'])
+        print('fleet.command: hosts={0} pool={1} wall={2:.2f}s '
+              'serial={3:.2f}s speedup={4:.1f}x failed={5}'.format(
+                  len(results), args.pool, wall_time, serial_time,
+                  serial_time / wall_time, failed))
+        return 1 if failed else 0
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Canux CHENG <canuxcheng@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Loopback Fabric hosts for the benchmarks.
+
+:func:`install` makes every remote operation of Fabric run on this machine
+instead of going through SSH: commands are run by the local shell and files
+are copied locally. Each host gets its own directory and remote paths under
+:data:`REMOTE_PREFIXES` are mapped into it, so ``central-1`` sees
+``/var/www/packages/apt`` in ``<root>/central-1/var/www/packages/apt``.
+
+Every command (streaming data to it or not) and upload is logged, one line
+each, to ``<root>/<host>.log``, which counts the SSH round-trips a real host
+would have served, including from the processes forked by parallel tasks.
+Use it from a fabfile::
+
+    import loopback
+    loopback.install('/tmp/central')
+"""
+
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from fabric import operations, sftp, state
+from fabric.exceptions import CommandTimeout
+from fabric.state import env, output
+
+# Remote directories mapped in the directory of each loopback host.
+REMOTE_PREFIXES = ('/var/www/packages/apt',)
+
+# Local processes run by the loopback hosts stand for the remote side, they
+# are not counted as local processes by fabric.trace.
+_popen_init = subprocess.Popen.__init__
+
+_root = None
+
+
+class _RemotePopen(subprocess.Popen):
+    __init__ = _popen_init
+
+
+def host_dir(host=None):
+    """Get the directory standing for the remote root of ``host``."""
+    return os.path.join(_root, host or env.host)
+
+
+def to_local(text, host=None):
+    """Map the remote paths found in ``text`` to the loopback host."""
+    for prefix in REMOTE_PREFIXES:
+        text = text.replace(prefix, host_dir(host) + prefix)
+    return text
+
+
+def to_remote(text, host=None):
+    """Map loopback host paths found in ``text`` back to remote paths."""
+    for prefix in REMOTE_PREFIXES:
+        text = text.replace(host_dir(host) + prefix, prefix)
+    return text
+
+
+def _log(kind, detail):
+    with open(host_dir() + '.log', 'a') as log:
+        log.write('{0:.6f}\t{1}\t{2}\n'.format(
+            time.time(), kind, detail.replace('\n', ' ')[:200]))
+
+
+class _LoopbackChannel(object):
+    """The part of ``paramiko.Channel`` used to stream data to a command."""
+
+    def __init__(self):
+        self.process = None
+
+    def settimeout(self, timeout):
+        pass
+
+    def set_combine_stderr(self, combine):
+        pass
+
+    def exec_command(self, command):
+        _log('run', command)
+        self.process = _RemotePopen(
+            ['/bin/sh', '-c', to_local(command)], cwd=host_dir(),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+
+    def sendall(self, data):
+        self.process.stdin.write(data)
+
+    def shutdown_write(self):
+        self.process.stdin.close()
+
+    def makefile(self, mode='rb'):
+        return self
+
+    def read(self):
+        return to_remote(self.process.stdout.read())
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+    def close(self):
+        pass
+
+
+def _default_channel():
+    return _LoopbackChannel()
+
+
+def _execute(channel, command, pty=True, combine_stderr=None,
+             invoke_shell=False, stdout=None, stderr=None, timeout=None,
+             capture_buffer_size=None):
+    """Stand-in of :func:`fabric.operations._execute` running locally."""
+    if combine_stderr is None:
+        combine_stderr = env.combine_stderr
+
+    _log('run', command)
+    process = _RemotePopen(
+        ['/bin/sh', '-c', to_local(command)], cwd=host_dir(),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT if combine_stderr or pty else subprocess.PIPE,
+        preexec_fn=os.setsid)
+
+    # Like a remote command, stop the whole command line on timeout
+    timer = None
+    if timeout:
+        timer = threading.Timer(
+            timeout, os.killpg, (process.pid, signal.SIGKILL))
+        timer.start()
+    try:
+        out, err = process.communicate()
+    finally:
+        if timer:
+            timer.cancel()
+    if timeout and process.returncode == -signal.SIGKILL:
+        raise CommandTimeout(timeout)
+    out, err = to_remote(out), to_remote(err or '')
+
+    if output.stdout and out:
+        (stdout or sys.stdout).write(out)
+    if output.stderr and err:
+        (stderr or sys.stderr).write(err)
+
+    return out.strip(), err.strip(), process.returncode
+
+
+class _LocalSFTPClient(object):
+    """The part of ``paramiko.SFTPClient`` used by uploads, on local files."""
+
+    def __init__(self):
+        if not os.path.isdir(host_dir()):
+            os.makedirs(host_dir())
+
+    def _path(self, path):
+        return to_local(path) if path.startswith('/') else \
+            os.path.join(host_dir(), path)
+
+    def normalize(self, path):
+        return '/' if path == '.' else path
+
+    def getcwd(self):
+        return None
+
+    def stat(self, path):
+        try:
+            return os.stat(self._path(path))
+        except OSError as e:
+            raise IOError(e.errno, e.strerror)
+
+    lstat = stat
+
+    def listdir(self, path):
+        return os.listdir(self._path(path))
+
+    def mkdir(self, path, mode=0o777):
+        os.mkdir(self._path(path), mode)
+
+    def chmod(self, path, mode):
+        os.chmod(self._path(path), mode)
+
+    def put(self, local_path, remote_path):
+        _log('put', remote_path)
+        shutil.copyfile(local_path, self._path(remote_path))
+        return self.stat(remote_path)
+
+    def putfo(self, fileobj, remote_path):
+        _log('put', remote_path)
+        with open(self._path(remote_path), 'wb') as remote_file:
+            shutil.copyfileobj(fileobj, remote_file)
+        return self.stat(remote_path)
+
+    def close(self):
+        pass
+
+
+class _LoopbackSFTP(sftp.SFTP):
+    def __init__(self, host_string):
+        self.ftp = _LocalSFTPClient()
+
+
+def install(root):
+    """
+    Run the remote operations of Fabric on loopback hosts.
+
+    :param root: directory holding a directory per host.
+    :type root: str
+    """
+    global _root
+    _root = os.path.abspath(root)
+
+    # A login shell would reset PATH and hide the stand-ins of the tools
+    env.shell = '/bin/bash -c'
+    operations.default_channel = state.default_channel = _default_channel
+    operations._execute = _execute
+    operations.SFTP = _LoopbackSFTP
+
+
+def round_trips(root, host):
+    """
+    Count the commands and uploads a loopback host served.
+
+    :rtype: dict
+    """
+    counts = {'run': 0, 'put': 0}
+    try:
+        with open(os.path.join(root, host) + '.log') as log:
+            for line in log:
+                counts[line.split('\t', 2)[1]] += 1
+    except IOError:
+        pass
+    return counts
@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Canux CHENG <canuxcheng@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Benchmark the release, upload and build tasks with local stand-ins.
+
+A throwaway packaging repository is created with ``--tags`` tags and
+``--entries`` changelog entries, a local bare ``origin``, and stand-ins of
+``git-buildpackage``, ``git-dch``, ``dh_listpackages``, ``gpg`` and (when not
+installed) ``apt-ftparchive`` on ``PATH``. The ``central`` role is made of
+``--hosts`` loopback hosts (see :mod:`loopback`), each one holding an APT
+repository of ``--pool`` packages.
+
+Every run releases a patch version, uploads again (nothing to send) and
+builds again (restored from the build cache), each one as a ``fab`` process
+traced with ``ZFABRIC_TRACE`` (see :mod:`fabric.trace`). The median latency
+of each task and the SSH round-trips (commands and uploads) served by the
+loopback hosts are reported, then the time, local processes, remote commands
+and bytes sent of each stage (work of nested stages and of the processes
+forked for parallel hosts is not counted in a stage). The ``sent`` column
+is a number of files for tasks and of bytes for stages.
+
+Usage::
+
+    python benchmarks/pipeline.py [-n RUNS] [--tags N] [--entries N]
+                                  [--pool N] [--hosts N] [--json FILE]
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import loopback
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+APTREPO = os.path.join(BENCHMARKS_DIR, os.pardir, 'fabric', 'tasks',
+                       'package', 'remote', 'aptrepo.py')
+
+DISTRIBUTION = 'trusty'
+MAINTAINER = 'Canux CHENG <canuxcheng@gmail.com>'
+DATE = 'Mon, 01 Aug 2016 10:00:00 +0800'
+
+FABFILE = """\
+import sys
+sys.path.insert(0, {benchmarks_dir!r})
+
+import loopback
+loopback.install({central_dir!r})
+
+from fabric import package
+"""
+
+CONTROL = """\
+Source: foo
+Maintainer: {maintainer}
+Build-Depends: debhelper (>= 9)
+
+Package: foo
+Architecture: all
+Description: benchmark package
+
+Package: foo-data
+Architecture: all
+Description: benchmark package data
+"""
+
+MAKEFILE = """\
+distclean:
+\t@true
+"""
+
+# Stand-ins of the packaging tools, they work in the current directory.
+TOOLS = {
+    'git-buildpackage': """\
+#!/bin/sh
+# Tag, or build a package of --package-size bytes per binary package.
+version=$(sed -n '1s/^[^(]*(\\([^)]*\\)).*/\\1/p' debian/changelog)
+out=pkg-build
+for arg; do
+    case "$arg" in
+        --git-tag-only) exec git tag "$version" ;;
+        --git-export-dir=*) out=${{arg#*=}} ;;
+    esac
+done
+mkdir -p "$out"
+for package in $(dh_listpackages); do
+    tree=$(mktemp -d)
+    mkdir -p "$tree/DEBIAN" "$tree/usr/share/$package"
+    printf 'Package: %s\\nVersion: %s\\nArchitecture: all\\n\
+Maintainer: {maintainer}\\nDescription: benchmark package\\n' \\
+        "$package" "$version" > "$tree/DEBIAN/control"
+    head -c {package_size} /dev/urandom > "$tree/usr/share/$package/data"
+    dpkg-deb -Znone --build "$tree" "$out/${{package}}_${{version}}_all.deb" \\
+        > /dev/null
+    rm -rf "$tree"
+done
+touch "$out/foo_$version.dsc" "$out/foo_${{version}}_all.changes"
+""",
+    'git-dch': """\
+#!/bin/sh
+# git-dch -R -N <version>: add a changelog entry for <version>.
+for arg; do version=$arg; done
+{{
+    sed -n "1s/([^)]*)/($version)/p" debian/changelog
+    printf '\\n  * Benchmark release.\\n\\n -- {maintainer}  %s\\n\\n' \\
+        "$(date -R)"
+    cat debian/changelog
+}} > debian/changelog.new
+mv debian/changelog.new debian/changelog
+""",
+    'dh_listpackages': """\
+#!/bin/sh
+sed -n 's/^Package: *//p' debian/control
+""",
+    'gpg': """\
+#!/bin/sh
+# No key here: the signature is a copy of the signed file.
+while [ $# -gt 1 ]; do
+    case "$1" in --output) output=$2; shift ;; esac
+    shift
+done
+cp "$1" "$output"
+""",
+}
+
+# Only used when apt-ftparchive is not installed.
+APT_FTPARCHIVE = """\
+#!/bin/sh
+# apt-ftparchive ... release .: hashes of the indexes only.
+echo "Date: $(date -R -u)"
+echo "Acquire-By-Hash: yes"
+echo "SHA256:"
+for index in Packages Packages.gz Packages.xz; do
+    if [ -e "$index" ]; then
+        echo " $(sha256sum "$index" | cut -d' ' -f1) \
+$(stat -c %s "$index") $index"
+    fi
+done
+"""
+
+# Tasks of a run, with the answers given to their prompts.
+TASKS = (
+    ('release', ['package.release.patch'], 'y\n'),
+    ('upload', ['package.upload:{}'.format(DISTRIBUTION)], ''),
+    ('build', ['package.build'], ''),
+)
+
+STAGE_COUNTERS = ('subprocesses', 'remote_commands', 'bytes_sent')
+
+
+def which(program):
+    """Find ``program`` on ``PATH``."""
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(path, program)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def write_script(path, content):
+    with open(path, 'w') as script:
+        script.write(content)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+def changelog(entries):
+    """
+    Build a changelog of ``entries`` entries, the last one being 1.0.0.
+
+    :rtype: str
+    """
+    versions = ['1.0.0'] + ['0.0.{}'.format(i)
+                            for i in reversed(range(entries - 1))]
+    return ''.join(
+        'foo ({0}) {1}; urgency=low\n\n  * Release {0}.\n\n'
+        ' -- {2}  {3}\n\n'.format(version, DISTRIBUTION, MAINTAINER, DATE)
+        for version in versions)
+
+
+def git(repository, *args):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(('git',) + args, cwd=repository, stdout=devnull)
+
+
+def make_tools(bindir, package_size):
+    """Write the stand-ins of the packaging tools in ``bindir``."""
+    os.makedirs(bindir)
+    for name, content in TOOLS.items():
+        write_script(os.path.join(bindir, name), content.format(
+            maintainer=MAINTAINER, package_size=package_size))
+    if not which('apt-ftparchive'):
+        write_script(os.path.join(bindir, 'apt-ftparchive'), APT_FTPARCHIVE)
+
+
+def make_repository(workdir, central_dir, tags, entries):
+    """
+    Create the packaging repository and its origin.
+
+    :return: path of the repository.
+    :rtype: str
+    """
+    repository = os.path.join(workdir, 'foo')
+    origin = os.path.join(workdir, 'origin.git')
+    os.makedirs(os.path.join(repository, 'debian'))
+
+    files = {
+        'fabfile.py': FABFILE.format(benchmarks_dir=BENCHMARKS_DIR,
+                                     central_dir=central_dir),
+        'Makefile': MAKEFILE,
+        '.gitignore': '*.pyc\npkg-build/\n',
+        'debian/changelog': changelog(entries),
+        'debian/control': CONTROL.format(maintainer=MAINTAINER),
+    }
+    for name, content in files.items():
+        with open(os.path.join(repository, name), 'w') as output_file:
+            output_file.write(content)
+
+    git(workdir, 'init', '-q', '--bare', origin)
+    git(repository, 'init', '-q')
+    git(repository, 'add', '.')
+    git(repository, 'commit', '-q', '-m', 'Initial packaging.')
+    git(repository, 'remote', 'add', 'origin', origin)
+
+    # Old releases, then the current one
+    refs = ''.join('create refs/tags/0.0.{} HEAD\n'.format(i)
+                   for i in range(tags - 1))
+    process = subprocess.Popen(['git', 'update-ref', '--stdin'],
+                               cwd=repository, stdin=subprocess.PIPE)
+    process.communicate(refs)
+    if process.returncode:
+        raise RuntimeError('Cannot create the tags.')
+    git(repository, 'tag', '1.0.0')
+    git(repository, 'push', '-q', 'origin', 'master', '--tags')
+
+    return repository
+
+
+def make_central(workdir, central_dir, hosts, pool):
+    """
+    Create the loopback central hosts, each with an indexed repository of
+    ``pool`` packages.
+
+    :return: names of the hosts.
+    :rtype: list(str)
+    """
+    debs = os.path.join(workdir, 'pool')
+    os.makedirs(debs)
+    for i in range(pool):
+        tree = os.path.join(workdir, 'tree')
+        os.makedirs(os.path.join(tree, 'DEBIAN'))
+        with open(os.path.join(tree, 'DEBIAN', 'control'), 'w') as control:
+            control.write('Package: filler{0}\nVersion: 1.0.{1}\n'
+                          'Architecture: all\nMaintainer: {2}\n'
+                          'Description: filler package\n'.format(
+                              i // 4, i % 4, MAINTAINER))
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                ['dpkg-deb', '-Znone', '--build', tree, os.path.join(
+                    debs, 'filler{0}_1.0.{1}_all.deb'.format(i // 4, i % 4))],
+                stdout=devnull)
+        shutil.rmtree(tree)
+
+    names = ['central-{}'.format(i + 1) for i in range(hosts)]
+    for name in names:
+        repository_dir = os.path.join(
+            central_dir, name, loopback.REMOTE_PREFIXES[0].lstrip('/'),
+            DISTRIBUTION)
+        shutil.copytree(debs, repository_dir)
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([sys.executable, APTREPO, 'index', '--full',
+                                   repository_dir], stderr=devnull)
+    return names
+
+
+def run_task(name, arguments, answers, repository, environ, trace_dir,
+             central_dir, hosts):
+    """
+    Run a fab task and gather its measures.
+
+    :rtype: dict
+    """
+    before = [loopback.round_trips(central_dir, host) for host in hosts]
+    environ = dict(environ, ZFABRIC_TRACE=trace_dir)
+
+    start = time.time()
+    process = subprocess.Popen(['fab'] + arguments, cwd=repository,
+                               env=environ, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output, _ = process.communicate(answers)
+    duration = time.time() - start
+    if process.returncode:
+        sys.stderr.write(output)
+        raise RuntimeError('fab {0} failed.'.format(' '.join(arguments)))
+
+    after = [loopback.round_trips(central_dir, host) for host in hosts]
+    # Nothing is written when no stage ran
+    stages = {}
+    for path in glob.glob(os.path.join(trace_dir, 'zfabric-*[0-9].json')):
+        with open(path) as summary_file:
+            stages = json.load(summary_file,
+                               object_pairs_hook=OrderedDict)['stages']
+
+    return {
+        'task': name,
+        'wall_time': duration,
+        'remote_commands': sum(a['run'] - b['run']
+                               for a, b in zip(after, before)),
+        'uploads': sum(a['put'] - b['put'] for a, b in zip(after, before)),
+        'stages': stages,
+    }
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def report(results):
+    """
+    Print the median of the measures of every task and stage.
+
+    :return: the medians, by task and stage.
+    :rtype: dict
+    """
+    by_task = OrderedDict()
+    for result in results:
+        by_task.setdefault(result['task'], []).append(result)
+
+    medians = OrderedDict()
+    print('{0:<34} {1:>9} {2:>9} {3:>9} {4:>9}'.format(
+        'task / stage', 'wall (s)', 'local', 'remote', 'sent'))
+
+    for task, runs in by_task.items():
+        medians[task] = {
+            'wall_time': median(run['wall_time'] for run in runs),
+            'remote_commands': median(run['remote_commands'] for run in runs),
+            'uploads': median(run['uploads'] for run in runs),
+            'stages': OrderedDict(),
+        }
+        print('{0:<34} {1:>9.3f} {2:>9} {3:>9} {4:>9}'.format(
+            task, medians[task]['wall_time'], '',
+            medians[task]['remote_commands'], medians[task]['uploads']))
+
+        names = []
+        for run in runs:
+            names.extend(name for name in run['stages'] if name not in names)
+        for name in names:
+            totals = [run['stages'].get(name) for run in runs]
+            stage = dict(
+                (measure, median(total[measure] if total else 0
+                                 for total in totals))
+                for measure in ('calls', 'wall_time') + STAGE_COUNTERS)
+            medians[task]['stages'][name] = stage
+            print('  {0:<32} {1:>9.3f} {2:>9} {3:>9} {4:>9}'.format(
+                name, stage['wall_time'], stage['subprocesses'],
+                stage['remote_commands'], stage['bytes_sent']))
+
+    return medians
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=5,
+                        help='number of runs (default: 5)')
+    parser.add_argument('--tags', type=int, default=200,
+                        help='tags in the repository (default: 200)')
+    parser.add_argument('--entries', type=int, default=200,
+                        help='changelog entries (default: 200)')
+    parser.add_argument('--pool', type=int, default=400,
+                        help='packages in each central repository '
+                             '(default: 400)')
+    parser.add_argument('--hosts', type=int, default=2,
+                        help='central hosts (default: 2)')
+    parser.add_argument('--package-size', type=int, default=65536,
+                        help='bytes of data in each built package '
+                             '(default: 65536)')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the medians in FILE')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='zfabric-pipeline-')
+    try:
+        central_dir = os.path.join(workdir, 'central')
+        bindir = os.path.join(workdir, 'bin')
+        make_tools(bindir, args.package_size)
+
+        environ = dict(os.environ)
+        environ['PATH'] = os.pathsep.join([bindir, environ.get('PATH', '')])
+        # Own caches (upstream, build, inventory) and git identity
+        environ['HOME'] = workdir
+        for role in ('AUTHOR', 'COMMITTER'):
+            environ['GIT_{}_NAME'.format(role)] = 'Canux CHENG'
+            environ['GIT_{}_EMAIL'.format(role)] = 'canuxcheng@gmail.com'
+        os.environ.update(environ)
+
+        repository = make_repository(workdir, central_dir, args.tags,
+                                     args.entries)
+        hosts = make_central(workdir, central_dir, args.hosts, args.pool)
+
+        inventory = os.path.join(workdir, 'inventory.json')
+        with open(inventory, 'w') as inventory_file:
+            json.dump({'central': hosts}, inventory_file)
+        environ['ZFABRIC_INVENTORY'] = inventory
+
+        results = []
+        for run in range(args.runs):
+            for name, arguments, answers in TASKS:
+                results.append(run_task(
+                    name, arguments, answers, repository, environ,
+                    os.path.join(workdir, 'trace', '{0}-{1}'.format(
+                        name, run)),
+                    central_dir, hosts))
+
+        print('runs={0} tags={1} entries={2} pool={3} hosts={4}\n'.format(
+            args.runs, args.tags, args.entries, args.pool, args.hosts))
+        medians = report(results)
+
+        if args.json:
+            with open(args.json, 'w') as json_file:
+                json.dump({'parameters': vars(args), 'tasks': medians},
+                          json_file, indent=2)
+        return 0
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
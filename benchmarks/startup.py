@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) Canux CHENG <canuxcheng@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Measure ``fab --list`` startup time without any network access.
+
+A throwaway packaging repository is created with an ``origin`` remote that
+cannot be reached and a ``git`` wrapper on ``PATH`` that records (and
+refuses) every command needing the network. The benchmark fails if listing
+the tasks tried to contact the remote.
+
+Usage::
+
+    python benchmarks/startup.py [-n RUNS]
+"""
+
+import argparse
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+FABFILE = """\
+from fabric import package
+"""
+
+CHANGELOG = """\
+foo (1.0.0) trusty; urgency=low
+
+  * Initial release.
+
+ -- Canux CHENG <canuxcheng@gmail.com>  Mon, 01 Aug 2016 10:00:00 +0800
+"""
+
+# Refuse network git commands and log them, pass everything else through.
+GIT_WRAPPER = """\
+#!/bin/sh
+case "$1" in
+    ls-remote|fetch|pull|push|clone)
+        echo "$@" >> "{log}"
+        exit 128
+        ;;
+esac
+exec "{git}" "$@"
+"""
+
+
+def which(program):
+    """Find ``program`` on ``PATH``."""
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(path, program)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def make_repository(workdir):
+    """Create the throwaway packaging repository and the git wrapper."""
+    repository = os.path.join(workdir, 'foo')
+    bindir = os.path.join(workdir, 'bin')
+    network_log = os.path.join(workdir, 'network.log')
+
+    os.makedirs(os.path.join(repository, 'debian'))
+    os.makedirs(bindir)
+
+    with open(os.path.join(repository, 'fabfile.py'), 'w') as fabfile:
+        fabfile.write(FABFILE)
+    with open(os.path.join(repository, 'debian', 'changelog'), 'w') as log:
+        log.write(CHANGELOG)
+
+    wrapper = os.path.join(bindir, 'git')
+    with open(wrapper, 'w') as script:
+        script.write(GIT_WRAPPER.format(log=network_log, git=which('git')))
+    os.chmod(wrapper, os.stat(wrapper).st_mode | stat.S_IEXEC)
+
+    for command in (['git', 'init', '-q'],
+                    ['git', 'remote', 'add', 'origin',
+                     'ssh://git@192.0.2.1/foo.git']):
+        subprocess.check_call(command, cwd=repository)
+
+    return repository, bindir, network_log
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=10,
+                        help='number of fab --list runs (default: 10)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='zfabric-startup-')
+    try:
+        repository, bindir, network_log = make_repository(workdir)
+        environ = dict(os.environ)
+        environ['PATH'] = os.pathsep.join([bindir, environ.get('PATH', '')])
+        # Do not reuse an upstream answer cached by a previous real run
+        environ['HOME'] = workdir
+
+        timings = []
+        with open(os.devnull, 'w') as devnull:
+            for _ in range(args.runs):
+                start = time.time()
+                subprocess.check_call(['fab', '--list'], cwd=repository,
+                                      env=environ, stdout=devnull)
+                timings.append(time.time() - start)
+
+        network_calls = 0
+        if os.path.exists(network_log):
+            with open(network_log) as log:
+                network_calls = len(log.readlines())
+
+        timings.sort()
+        print('fab --list: runs={0} min={1:.3f}s median={2:.3f}s '
+              'max={3:.3f}s network_calls={4}'.format(
+                  len(timings), timings[0], timings[len(timings) // 2],
+                  timings[-1], network_calls))
+        return 1 if network_calls else 0
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
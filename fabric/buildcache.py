@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Canux CHENG <canuxcheng@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Local cache of build results.
+
+Built files are stored per key, made of the git tree of the sources, the
+changelog version, the distribution and the architecture, so an identical
+tree is never built twice. The least recently used entries are evicted when
+the cache grows over ``env.build_cache_size`` MiB.
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+
+from fabric.api import env
+
+from fabric import git, helpers
+
+CACHE_DIR = os.path.expanduser('~/.cache/zfabric/builds')
+
+# Default maximum size of the cache, in MiB. Override with
+# ``fab --set build_cache_size=<MiB>``.
+CACHE_SIZE = 2048
+
+_lock = threading.Lock()
+
+
+def get_key(distribution, architecture):
+    """
+    Compute the cache key of the current sources.
+
+    :param distribution: distribution the package is built for.
+    :type distribution: str
+    :param architecture: architecture the package is built for.
+    :type architecture: str
+    :return: the key or None if the working copy has uncommitted changes,
+             the built tree is then unknown.
+    :rtype: str
+    """
+    if not git.is_clean():
+        return None
+
+    key = hashlib.sha256()
+    for part in (git.get_tree_hash(), helpers.read_changelog().head.version,
+                 distribution, architecture):
+        key.update(part.encode('utf-8') + b'\0')
+    return key.hexdigest()
+
+
+def restore(key, destination):
+    """
+    Copy the files cached for ``key`` in ``destination``, as new files.
+
+    :return: the restored paths or None if ``key`` is not cached.
+    :rtype: list(str)
+    """
+    if not key:
+        return None
+
+    entry = os.path.join(CACHE_DIR, key)
+    if not os.path.isdir(entry):
+        return None
+
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+
+    restored = []
+    for name in sorted(os.listdir(entry)):
+        # Fresh modification time, see helpers.get_build_dir()
+        shutil.copy(os.path.join(entry, name), destination)
+        restored.append(os.path.join(destination, name))
+
+    # Mark the entry as recently used
+    os.utime(entry, None)
+    return restored
+
+
+def store(key, paths):
+    """
+    Cache the built files ``paths`` for ``key`` and evict old entries.
+
+    :param key: cache key, see :func:`get_key`.
+    :type key: str
+    :param paths: the built files.
+    :type paths: list(str)
+    """
+    if not key or not paths:
+        return
+
+    entry = os.path.join(CACHE_DIR, key)
+    tmp_entry = '{0}.{1}.{2}.tmp'.format(entry, os.getpid(),
+                                         threading.current_thread().ident)
+    os.makedirs(tmp_entry)
+    for path in paths:
+        shutil.copy2(path, tmp_entry)
+
+    # Matrix builds store from several threads
+    with _lock:
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp_entry, entry)
+
+        evict(int(env.get('build_cache_size', CACHE_SIZE)) * 1024 * 1024)
+
+
+def evict(max_size):
+    """
+    Remove the least recently used entries until the cache fits in
+    ``max_size`` bytes.
+
+    :param max_size: maximum size of the cache, in bytes.
+    :type max_size: int
+    """
+    entries = []
+    total = 0
+    for key in os.listdir(CACHE_DIR):
+        entry = os.path.join(CACHE_DIR, key)
+        if key.endswith('.tmp') or not os.path.isdir(entry):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, name))
+                   for name in os.listdir(entry))
+        entries.append((os.path.getmtime(entry), size, entry))
+        total += size
+
+    for _, size, entry in sorted(entries):
+        if total <= max_size:
+            break
+        shutil.rmtree(entry)
+        total -= size
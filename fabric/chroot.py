@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Canux CHENG <canuxcheng@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Build chroots reused between builds.
+
+Packages are built with cowbuilder from snapshots kept under
+``env.chroot_dir``:
+
+* ``<distribution>-<architecture>/base.cow``, created once, a minimal
+  chroot of the distribution;
+* ``<distribution>-<architecture>/deps-<key>.cow``, a copy of the base with
+  the build dependencies installed, keyed on the ``Build-Depends`` fields of
+  ``debian/control``. A clean build of sources whose build dependencies did
+  not change starts from it and installs nothing. The least recently used
+  snapshots are removed past ``env.chroot_snapshots``.
+
+Each build runs in its own hardlinked copy of the snapshot made by
+cowbuilder, so builds never change it. Builds hold a shared lock on the
+snapshots of their distribution and architecture: a snapshot is only evicted
+when no build uses them, and snapshots are created one at a time under
+another lock, without waiting for the running builds. Downloaded packages
+are kept in ``aptcache/<distribution>-<architecture>``. ``fab --set
+chroot_mirror=<url or path>`` replaces the package mirror, a local directory
+(a mirror with ``dists/`` or a flat repository with a ``Packages`` index) is
+bind mounted in the chroots.
+"""
+
+import errno
+import fcntl
+import glob
+import hashlib
+import os
+import pipes
+import tempfile
+from contextlib import contextmanager
+
+from fabric.api import env, hide, local, puts
+from fabric.colors import cyan
+
+from fabric import helpers, stream, trace
+
+CHROOT_DIR = '/var/cache/zfabric/chroots'
+
+# Default number of build dependency snapshots kept per distribution and
+# architecture. Override with ``fab --set chroot_snapshots=<count>``.
+SNAPSHOTS_KEPT = 4
+
+# Lock files of the chroots of a distribution and architecture: shared by
+# the builds using them, and serializing their creation.
+USE_LOCK = 'use.lock'
+CREATE_LOCK = 'create.lock'
+
+# Run inside the chroot by ``cowbuilder --execute``.
+INSTALL_SCRIPT = """\
+#!/bin/sh
+set -e
+apt-get update
+DEBIAN_FRONTEND=noninteractive apt-get install -y --no-install-recommends "$@"
+apt-get clean
+"""
+
+
+def _root():
+    return env.get('chroot_dir', CHROOT_DIR)
+
+
+def _as_root(command):
+    """Prefix ``command`` with sudo if needed, the chroots belong to root."""
+    if os.geteuid() != 0:
+        command = ['sudo'] + command
+    return command
+
+
+def _run(*command):
+    with hide('running'):
+        local(' '.join(pipes.quote(part)
+                       for part in _as_root(list(command))), capture=True)
+
+
+def _cowbuilder(arguments, log):
+    stream.local(_as_root(['cowbuilder'] + arguments), log, progress=False)
+
+
+def _mirror_options():
+    """
+    Get the pbuilder options using ``env.chroot_mirror``.
+
+    :rtype: list(str)
+    """
+    mirror = env.get('chroot_mirror')
+    if not mirror:
+        return []
+    if not os.path.isdir(mirror):
+        return ['--mirror', mirror]
+
+    mirror = os.path.abspath(mirror)
+    options = ['--bindmounts', mirror]
+    if os.path.isdir(os.path.join(mirror, 'dists')):
+        return options + ['--mirror', 'file://' + mirror]
+    return options + ['--othermirror',
+                      'deb [trusted=yes] file://{} ./'.format(mirror)]
+
+
+def _aptcache(distribution, architecture):
+    return os.path.join(_root(), 'aptcache', '{0}-{1}'.format(
+        distribution, architecture))
+
+
+def get_key(distribution, architecture, base, arch_indep=True):
+    """
+    Compute the key of the build dependency snapshot of the current sources.
+
+    :param distribution: distribution the package is built for.
+    :type distribution: str
+    :param architecture: architecture the package is built for.
+    :type architecture: str
+    :param base: path to the base chroot the snapshot is made from.
+    :type base: str
+    :param arch_indep: the architecture independent dependencies are
+                       installed too.
+    :type arch_indep: bool
+    :rtype: str
+    """
+    source = helpers.read_control().source
+
+    key = hashlib.sha256()
+    # The dependencies installed depend on the build profiles too
+    profiles = ' '.join(sorted(set(
+        os.environ.get('DEB_BUILD_PROFILES', '').split())))
+    parts = [distribution, architecture, str(arch_indep), profiles,
+             str(int(os.stat(base).st_mtime)), env.get('chroot_mirror', '')]
+    parts.extend(source.get(field, '') for field in (
+        'Build-Depends', 'Build-Depends-Arch', 'Build-Depends-Indep'))
+    for part in parts:
+        key.update(part.encode('utf-8') + b'\0')
+    return key.hexdigest()
+
+
+def _open_lock(directory, name):
+    """
+    Open a lock file next to the chroots, shared by every user building
+    with them. It belongs to root: it is opened read only, enough for
+    flock().
+    """
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        _run('mkdir', '-p', directory)
+        _run('touch', path)
+    return open(path)
+
+
+def _create_base(base, distribution, architecture, log):
+    puts(cyan('{0}/{1}: creating the base chroot...'.format(
+        distribution, architecture)))
+    tmp_base = base + '.tmp'
+    _run('rm', '-rf', tmp_base)
+    _run('mkdir', '-p', os.path.dirname(base),
+         _aptcache(distribution, architecture))
+    _cowbuilder(['--create',
+                 '--distribution', distribution,
+                 '--architecture', architecture,
+                 '--basepath', tmp_base,
+                 '--aptcache', _aptcache(distribution, architecture)] +
+                _mirror_options(), log)
+    _run('mv', tmp_base, base)
+
+
+def _create_snapshot(snapshot, base, distribution, architecture, arch_indep,
+                     log):
+    packages = helpers.get_build_depends(architecture, arch_indep)
+    puts(cyan('{0}/{1}: installing {2} build dependencies...'.format(
+        distribution, architecture, len(packages))))
+
+    # A real copy: the installation writes some files in place, which would
+    # change the base through hardlinks.
+    tmp_snapshot = snapshot + '.tmp'
+    _run('rm', '-rf', tmp_snapshot)
+    _run('cp', '-a', base, tmp_snapshot)
+
+    if packages:
+        fd, script = tempfile.mkstemp(prefix='zfabric-deps-', suffix='.sh')
+        try:
+            with os.fdopen(fd, 'w') as install:
+                install.write(INSTALL_SCRIPT)
+            os.chmod(script, 0o755)
+            _cowbuilder(['--execute', '--save-after-exec',
+                         '--basepath', tmp_snapshot,
+                         '--aptcache', _aptcache(distribution, architecture)] +
+                        _mirror_options() + ['--', script] + packages, log)
+        finally:
+            os.remove(script)
+
+    _run('mv', tmp_snapshot, snapshot)
+
+
+def _evict(directory, keep):
+    """Remove the least recently used snapshots of ``directory``."""
+    snapshots = sorted(glob.glob(os.path.join(directory, 'deps-*.cow')),
+                       key=os.path.getmtime, reverse=True)
+    for snapshot in snapshots[keep:]:
+        _run('rm', '-rf', snapshot)
+
+
+def _find_snapshot(directory, distribution, architecture, arch_indep):
+    """Get the path to the snapshot of the current sources, if created."""
+    base = os.path.join(directory, 'base.cow')
+    if not os.path.isdir(base):
+        return None
+    path = os.path.join(directory, 'deps-{}.cow'.format(get_key(
+        distribution, architecture, base, arch_indep)[:16]))
+    return path if os.path.isdir(path) else None
+
+
+def _create(directory, distribution, architecture, arch_indep, log,
+            use_lock):
+    """
+    Create the snapshot of the current sources, and the base chroot if
+    needed, then evict the least recently used snapshots unless a build
+    uses them (retried at the next creation).
+    """
+    with _open_lock(directory, CREATE_LOCK) as create_lock:
+        fcntl.flock(create_lock, fcntl.LOCK_EX)
+        with trace.stage('chroot.snapshot'):
+            base = os.path.join(directory, 'base.cow')
+            if not os.path.isdir(base):
+                _create_base(base, distribution, architecture,
+                             log.format('base'))
+
+            # Another build may have created it meanwhile
+            if not _find_snapshot(directory, distribution, architecture,
+                                  arch_indep):
+                path = os.path.join(directory, 'deps-{}.cow'.format(get_key(
+                    distribution, architecture, base, arch_indep)[:16]))
+                _create_snapshot(path, base, distribution, architecture,
+                                 arch_indep, log.format('deps'))
+                _run('touch', path)
+
+    try:
+        fcntl.flock(use_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return
+    try:
+        _evict(directory, int(env.get('chroot_snapshots', SNAPSHOTS_KEPT)))
+    finally:
+        fcntl.flock(use_lock, fcntl.LOCK_UN)
+
+
+@contextmanager
+def snapshot(distribution, architecture, arch_indep=True, log_dir=None):
+    """
+    Get the build dependency snapshot of the current sources, created if
+    needed with its base chroot.
+
+    The snapshot is not evicted until the block exits::
+
+        with chroot.snapshot('trusty', 'amd64') as basepath:
+            ...
+
+    :param distribution: distribution the package is built for.
+    :type distribution: str
+    :param architecture: architecture the package is built for.
+    :type architecture: str
+    :param arch_indep: install the architecture independent dependencies.
+    :type arch_indep: bool
+    :param log_dir: directory of the cowbuilder logs, default to the build
+                    directory.
+    :type log_dir: str
+    :return: path to the snapshot.
+    :rtype: str
+    """
+    directory = os.path.join(_root(), '{0}-{1}'.format(
+        distribution, architecture))
+    log = os.path.join(log_dir or helpers.BUILD_DIR,
+                       'chroot_{0}_{1}_{{}}.log'.format(distribution,
+                                                      architecture))
+
+    with _open_lock(directory, USE_LOCK) as use_lock:
+        while True:
+            fcntl.flock(use_lock, fcntl.LOCK_SH)
+            path = _find_snapshot(directory, distribution, architecture,
+                                  arch_indep)
+            if path:
+                break
+            # Not held while creating, eviction needs it exclusively
+            fcntl.flock(use_lock, fcntl.LOCK_UN)
+            _create(directory, distribution, architecture, arch_indep, log,
+                    use_lock)
+
+        puts(cyan('{0}/{1}: using the build dependencies of {2}.'.format(
+            distribution, architecture, os.path.basename(path))))
+        # Mark the snapshot as recently used
+        _run('touch', path)
+        yield path
+
+
+def get_builder(distribution, architecture, basepath, result_dir,
+                arch_indep=True):
+    """
+    Get the ``git-buildpackage`` option building in the snapshot
+    ``basepath`` with cowbuilder.
+
+    :param result_dir: directory receiving the build results.
+    :type result_dir: str
+    :param arch_indep: build the architecture independent packages.
+    :type arch_indep: bool
+    :rtype: str
+    """
+    options = ['--basepath', basepath,
+               '--aptcache', _aptcache(distribution, architecture)]
+    options.extend(_mirror_options())
+    if not arch_indep:
+        options.append('--binary-arch')
+
+    builder = ['pdebuild', '--pbuilder', 'cowbuilder',
+               '--buildresult', os.path.abspath(result_dir), '--'] + options
+    return '--git-builder={}'.format(
+        ' '.join(pipes.quote(part) for part in builder))
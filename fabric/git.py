@@ -21,9 +21,114 @@
 
 """Manipulate Git repository."""
 
+import subprocess
+
 from fabric.api import *
 
 
+class RepoState(object):
+    """
+    Snapshot of the refs of the repository, read with a single
+    ``git for-each-ref`` call.
+
+    Queries are answered from memory, so the snapshot must be dropped with
+    :func:`invalidate` after anything creating or removing refs (fetch,
+    tagging...). Use :func:`get_state` to get the current snapshot.
+    """
+
+    def __init__(self, refs):
+        """
+        :param refs: full names of the refs (eg. ``refs/tags/1.0.0``).
+        :type refs: iterable
+        """
+        self.refs = frozenset(refs)
+        self.tags = frozenset(ref[len('refs/tags/'):] for ref in self.refs
+                              if ref.startswith('refs/tags/'))
+
+        # ``git show-ref --tags <pattern>`` matches the tail of the ref name
+        # on a path component boundary, index every possible tail.
+        tails = set()
+        for tag in self.tags:
+            parts = tag.split('/')
+            for i in range(len(parts)):
+                tails.add('/'.join(parts[i:]))
+        self._tag_tails = frozenset(tails)
+
+    @classmethod
+    def read(cls):
+        """
+        Read the refs of the repository in the current directory.
+
+        :rtype: RepoState
+        """
+        output = subprocess.check_output(
+            ['git', 'for-each-ref', '--format=%(refname)'])
+        return cls(output.splitlines())
+
+    @property
+    def tag_count(self):
+        """Number of tags in the repository."""
+        return len(self.tags)
+
+    def has_tag(self, tagname=None):
+        """
+        Same as :func:`has_tag` but answered from the snapshot.
+
+        :param tagname: tag to look for, or None for any tag.
+        :type tagname: str
+        :rtype: bool
+        """
+        if tagname:
+            return tagname in self._tag_tails
+        return self.tag_count > 0
+
+
+_state = None
+
+
+def get_state():
+    """
+    Get the refs snapshot of the repository, reading it if needed.
+
+    :rtype: RepoState
+    """
+    global _state
+
+    if _state is None:
+        _state = RepoState.read()
+    return _state
+
+
+def invalidate():
+    """Drop the refs snapshot, the next query will read the refs again."""
+    global _state
+
+    _state = None
+
+
+def get_tree_hash(revision='HEAD'):
+    """
+    Get the hash of the tree of a revision, it identifies its content.
+
+    :param revision: the revision.
+    :type revision: str
+    :rtype: str
+    """
+    return subprocess.check_output(
+        ['git', 'rev-parse', '{}^{{tree}}'.format(revision)]).strip()
+
+
+def is_clean():
+    """
+    Check that the working copy has no uncommitted change (untracked files
+    are ignored).
+
+    :rtype: bool
+    """
+    return not subprocess.check_output(
+        ['git', 'status', '--porcelain', '--untracked-files=no']).strip()
+
+
 def fetch(all_remotes=False):
     """
     Fetch remote repository for changes. Can check all remotes.
@@ -31,10 +136,13 @@ def fetch(all_remotes=False):
     :param all_remotes: set it to True if all remotes should be fetched.
     :type all_remotes: bool
     """
-    if all_remotes:
-        local('git fetch --all')
-    else:
-        local('git fetch origin')
+    try:
+        if all_remotes:
+            local('git fetch --all')
+        else:
+            local('git fetch origin')
+    finally:
+        invalidate()
 
 
 def push():
@@ -42,11 +150,27 @@ def push():
     local('git push origin master --tags')
 
 
+def delete_tag(tagname):
+    """
+    Delete a local tag.
+
+    :param tagname: the tag to delete.
+    :type tagname: str
+    """
+    try:
+        local('git tag -d {}'.format(tagname))
+    finally:
+        invalidate()
+
+
 def has_tag(tagname=None):
     """
     Check if a tag is found with ``tagname`` or if none specified check if
     project have at least one tag.
 
+    Answers come from the refs snapshot (see :class:`RepoState`), so calling
+    this several times only reads the refs once.
+
     :param tagname: specify the tag that should be checked for existence.
     :type tagname: str
     :return: True if specified tag exists or the project has tags. False
@@ -59,17 +183,10 @@ def has_tag(tagname=None):
     >>> has_tag()
     True
     """
-    import subprocess
     import traceback
 
     try:
-        if tagname:
-            t = subprocess.call(['git', 'show-ref', '-q', '--tags', tagname])
-            return True if t == 0 else False
-        else:
-            t = int(subprocess.check_output('git tag | wc -l', shell=True))
-            return True if t > 0 else False
+        return get_state().has_tag(tagname)
     except:
         print "Exception raised:\n%s" % traceback.format_exc()
         abort('Error: not able to check if project have tags !')
-
@@ -21,44 +21,570 @@
 
 """Helpers functions."""
 
+import json
+import os
+import platform
+import re
 import subprocess
+import time
+from collections import namedtuple
 
-from fabric.api import local, abort
+from fabric.api import env, local, abort
 
+from fabric import git, trace
 
-def package_has_upstream():
+# Distributions packages can be built and uploaded for.
+SUPPORTED_DISTRIBUTIONS = (
+    'precise',
+    'trusty',
+)
+
+# Directory where git-buildpackage exports and builds the package.
+BUILD_DIR = 'pkg-build'
+
+# Changelog and control file of the package in the working copy.
+CHANGELOG = 'debian/changelog'
+CONTROL = 'debian/control'
+
+# Debian architecture of the common machine types, see
+# get_host_architecture().
+MACHINE_ARCHITECTURES = {
+    'x86_64': 'amd64',
+    'amd64': 'amd64',
+    'i386': 'i386',
+    'i486': 'i386',
+    'i586': 'i386',
+    'i686': 'i386',
+    'aarch64': 'arm64',
+    'armv7l': 'armhf',
+    'ppc64le': 'ppc64el',
+    's390x': 's390x',
+}
+
+# Where the result of the remote pristine-tar lookup is remembered.
+UPSTREAM_CACHE = os.path.expanduser('~/.cache/zfabric/upstream.json')
+
+# Default lifetime of a cached upstream lookup, in seconds. Override with
+# ``fab --set upstream_cache_ttl=<seconds>``.
+UPSTREAM_CACHE_TTL = 3600
+
+
+def is_true(value):
+    """
+    Interpret a task argument as a boolean, Fabric gives them as strings.
+
+    :rtype: bool
+    """
+    if isinstance(value, basestring):
+        return value.lower() in ('1', 'true', 'yes', 'y', 'on')
+    return bool(value)
+
+
+def file_checksum(path, algorithm='sha256'):
+    """
+    Compute the checksum of a file without loading it in memory.
+
+    :param path: path to the file.
+    :type path: str
+    :param algorithm: any algorithm of :mod:`hashlib`.
+    :type algorithm: str
+    :return: the hexadecimal digest.
+    :rtype: str
+    """
+    import hashlib
+
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as checked:
+        for block in iter(lambda: checked.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_remote_url(remote='origin'):
+    """
+    Get the URL of a git remote from the local configuration (no network).
+
+    :param remote: name of the remote.
+    :type remote: str
+    :return: the remote URL or None if the remote is not configured.
+    :rtype: str
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'config', '--get', 'remote.{}.url'.format(remote)]).strip()
+    except subprocess.CalledProcessError:
+        return None
+
+
+def _load_upstream_cache():
+    try:
+        with open(UPSTREAM_CACHE) as cache_file:
+            return json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_upstream_cache(cache):
+    try:
+        cache_dir = os.path.dirname(UPSTREAM_CACHE)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = '{}.{}'.format(UPSTREAM_CACHE, os.getpid())
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(cache, cache_file)
+        os.rename(tmp_path, UPSTREAM_CACHE)
+    except (IOError, OSError):
+        # The cache is only an optimisation, never fail a task because of it
+        pass
+
+
+def package_has_upstream(ttl=None):
     """
     Test if the package has a upstream source by looking if pristine-tar branch
     exists in remote origin.
 
+    The answer is cached per remote URL for ``ttl`` seconds (default to
+    ``env.upstream_cache_ttl`` or :data:`UPSTREAM_CACHE_TTL`) so only the
+    first call in that window pays the ``git ls-remote`` round-trip.
+
+    :param ttl: how long a cached answer stays valid, in seconds.
+    :type ttl: int
     :rtype: bool
     """
-    try:
-        subprocess.check_call(
+    if ttl is None:
+        ttl = int(env.get('upstream_cache_ttl', UPSTREAM_CACHE_TTL))
+
+    url = get_remote_url()
+    cache = _load_upstream_cache()
+    entry = cache.get(url) if url else None
+    if entry and 0 <= time.time() - entry['checked_at'] < ttl:
+        return entry['has_upstream']
+
+    # Exit code 2 means the ref is missing, anything else but 0 is an error
+    # (network, authentication...) and must not be cached.
+    with trace.stage('helpers.ls_remote'):
+        status = subprocess.call(
             'git ls-remote --exit-code '
             'origin refs/heads/pristine-tar 2>&1 >/dev/null',
             shell=True)
+    has_upstream = status == 0
+
+    if url and status in (0, 2):
+        cache[url] = {
+            'has_upstream': has_upstream,
+            'checked_at': time.time(),
+        }
+        _save_upstream_cache(cache)
+
+    return has_upstream
+
+
+ChangelogEntry = namedtuple(
+    'ChangelogEntry',
+    'package version distributions urgency maintainer date')
+
+
+class Changelog(object):
+    """
+    Reader for a ``debian/changelog`` file.
+
+    :attr:`head` only reads the file up to the end of the first entry, which
+    is all the release tasks need. :attr:`entries` indexes the whole history
+    the first time it is accessed.
+
+    Use :func:`read_changelog` to get instances cached on the file state.
+    """
+
+    _header = re.compile(
+        r'^(?P<package>[a-zA-Z0-9][a-zA-Z0-9.+\-]*)\s+\((?P<version>[^)]+)\)'
+        r'\s+(?P<distributions>[^;]*);\s*(?P<options>.*)$')
+    _trailer = re.compile(r'^ -- (?P<maintainer>.*?)  (?P<date>.*)$')
+
+    def __init__(self, path=CHANGELOG):
+        """
+        :param path: path to the changelog file.
+        :type path: str
+        """
+        self.path = path
+        self._head = None
+        self._entries = None
+
+    @property
+    def head(self):
+        """
+        The most recent entry, or None if the changelog has no entry.
+
+        :rtype: ChangelogEntry
+        """
+        if self._head is None:
+            if self._entries is not None:
+                self._head = self._entries[0] if self._entries else None
+            else:
+                self._head = next(self._iter_entries(), None)
+        return self._head
+
+    @property
+    def entries(self):
+        """
+        All the entries, most recent first.
+
+        :rtype: list(ChangelogEntry)
+        """
+        if self._entries is None:
+            self._entries = list(self._iter_entries())
+        return self._entries
+
+    def _iter_entries(self):
+        entry = None
+
+        with open(self.path) as changelog:
+            for line in changelog:
+                line = line.rstrip('\n')
+
+                header = self._header.match(line)
+                if header:
+                    if entry:
+                        yield ChangelogEntry(**entry)
+                    options = dict(
+                        option.strip().split('=', 1)
+                        for option in header.group('options').split(',')
+                        if '=' in option)
+                    entry = {
+                        'package': header.group('package'),
+                        'version': header.group('version'),
+                        'distributions': tuple(
+                            header.group('distributions').split()),
+                        'urgency': options.get('urgency'),
+                        'maintainer': None,
+                        'date': None,
+                    }
+                    continue
+
+                trailer = self._trailer.match(line)
+                if trailer and entry:
+                    entry['maintainer'] = trailer.group('maintainer')
+                    entry['date'] = trailer.group('date').strip()
+                    yield ChangelogEntry(**entry)
+                    entry = None
+
+        if entry:
+            yield ChangelogEntry(**entry)
+
+
+_changelogs = {}
+
+
+def read_changelog(path=CHANGELOG):
+    """
+    Get a :class:`Changelog` for ``path``. The parsing is cached and reused
+    as long as the modification time and size of the file do not change.
+
+    :param path: path to the changelog file.
+    :type path: str
+    :rtype: Changelog
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (stat.st_mtime, stat.st_size)
+
+    cached = _changelogs.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    changelog = Changelog(path)
+    _changelogs[path] = (key, changelog)
+    return changelog
+
+
+class Control(object):
+    """
+    Parsed ``debian/control`` file: the source paragraph and the binary
+    package paragraphs. Field names are case insensitive, they are stored
+    capitalized (eg. ``Package-Type``).
+
+    Use :func:`read_control` to get instances cached on the file state.
+    """
+
+    def __init__(self, path=CONTROL):
+        """
+        :param path: path to the control file.
+        :type path: str
+        """
+        self.path = path
+        paragraphs = list(self._iter_paragraphs())
+        self.source = paragraphs[0] if paragraphs else {}
+        self.packages = paragraphs[1:]
+
+    def _iter_paragraphs(self):
+        paragraph, field = {}, None
+
+        with open(self.path) as control:
+            for line in control:
+                line = line.rstrip('\n')
+                if line.startswith('#'):
+                    continue
+                if not line.strip():
+                    if paragraph:
+                        yield paragraph
+                    paragraph, field = {}, None
+                elif line[0] in ' \t':
+                    if field:
+                        paragraph[field] += '\n' + line
+                elif ':' in line:
+                    field, value = line.split(':', 1)
+                    field = field.strip().title()
+                    paragraph[field] = value.strip()
+
+        if paragraph:
+            yield paragraph
+
+
+_controls = {}
+
+
+def read_control(path=CONTROL):
+    """
+    Get a :class:`Control` for ``path``. The parsing is cached and reused
+    as long as the modification time and size of the file do not change.
+
+    :param path: path to the control file.
+    :type path: str
+    :rtype: Control
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (stat.st_mtime, stat.st_size)
+
+    cached = _controls.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    control = Control(path)
+    _controls[path] = (key, control)
+    return control
+
+
+_host_architecture = None
+
+
+def get_host_architecture():
+    """
+    Get the Debian architecture packages are built for: ``DEB_HOST_ARCH``
+    when set, else guessed from the machine type, else asked to dpkg once.
+
+    :rtype: str
+    """
+    global _host_architecture
+
+    if os.environ.get('DEB_HOST_ARCH'):
+        return os.environ['DEB_HOST_ARCH']
+    if _host_architecture is None:
+        _host_architecture = MACHINE_ARCHITECTURES.get(
+            platform.machine().lower()) or get_build_architecture()
+    return _host_architecture
+
+
+def _split_architecture(architecture):
+    """Split a Debian architecture (or wildcard) in OS and CPU."""
+    if architecture == 'any':
+        return 'any', 'any'
+    if '-' in architecture:
+        return tuple(architecture.split('-', 1))
+    return 'linux', architecture
+
+
+def architecture_matches(architecture, wildcard):
+    """
+    Check if ``architecture`` is matched by ``wildcard`` like
+    ``dpkg-architecture -i`` (eg. amd64 is matched by amd64, any, linux-any
+    and any-amd64).
+
+    :rtype: bool
+    """
+    if wildcard in ('any', architecture):
         return True
-    except subprocess.CalledProcessError:
-        return False
+    os_name, cpu = _split_architecture(architecture)
+    wildcard_os, wildcard_cpu = _split_architecture(wildcard)
+    return wildcard_os in ('any', os_name) and wildcard_cpu in ('any', cpu)
 
 
-def get_package_list():
+def _profiles_match(restrictions, profiles):
+    """
+    Check a ``Build-Profiles`` field (eg. ``<!nocheck> <stage1>``) against
+    the active profiles: one of the groups must have all its terms true.
     """
-    Get the names of all generated deb packages.
+    groups = re.findall(r'<([^>]*)>', restrictions)
+    if not groups:
+        return True
+    for group in groups:
+        if all((term[1:] not in profiles) if term.startswith('!')
+               else (term in profiles) for term in group.split()):
+            return True
+    return False
 
+
+def get_package_list(arch_indep=True, arch_dep=True, package_types=None,
+                     control=CONTROL):
+    """
+    Get the names of the binary packages built on this machine, like
+    ``dh_listpackages``: ``Architecture: all`` packages and the ones matching
+    the host architecture (see :func:`get_host_architecture`), without the
+    ones excluded by the ``DEB_BUILD_PROFILES`` build profiles.
+
+    The control file is parsed in-process and cached (see
+    :func:`read_control`), so this can be called often.
+
+    :param arch_indep: include architecture independent packages.
+    :type arch_indep: bool
+    :param arch_dep: include architecture dependent packages.
+    :type arch_dep: bool
+    :param package_types: keep only these package types (deb, udeb), all
+                          when None.
+    :type package_types: tuple
+    :param control: path to the control file.
+    :type control: str
     :return: the list of package names.
     :rtype: list(str)
     """
-    names = local('dh_listpackages', capture=True)
-    return names.splitlines()
+    profiles = os.environ.get('DEB_BUILD_PROFILES', '').split()
+    host = None
+
+    names = []
+    for package in read_control(control).packages:
+        if 'Package' not in package:
+            continue
+
+        package_type = package.get('Package-Type') or \
+            package.get('Xc-Package-Type') or 'deb'
+        if package_types and package_type not in package_types:
+            continue
+
+        architectures = package.get('Architecture', '').split()
+        if 'all' in architectures:
+            if not arch_indep:
+                continue
+        else:
+            if not arch_dep:
+                continue
+            host = host or get_host_architecture()
+            if not any(architecture_matches(host, wildcard)
+                       for wildcard in architectures):
+                continue
+
+        if not _profiles_match(package.get('Build-Profiles', ''), profiles):
+            continue
+
+        names.append(package['Package'])
+    return names
+
+
+def get_build_depends(architecture, arch_indep=True, control=CONTROL):
+    """
+    Get the packages to install to build the package for ``architecture``:
+    the first alternative of each ``Build-Depends`` (and ``-Arch``,
+    ``-Indep`` if ``arch_indep``) relation that applies to the architecture
+    and the ``DEB_BUILD_PROFILES`` build profiles, like pbuilder does.
+
+    Versions and architecture qualifiers are dropped: a relation not
+    satisfied this way is left to the dependency resolution of the build.
+
+    :param architecture: architecture built for.
+    :type architecture: str
+    :param arch_indep: include the architecture independent dependencies.
+    :type arch_indep: bool
+    :param control: path to the control file.
+    :type control: str
+    :return: the package names.
+    :rtype: list(str)
+    """
+    profiles = os.environ.get('DEB_BUILD_PROFILES', '').split()
+    source = read_control(control).source
+
+    fields = ['Build-Depends', 'Build-Depends-Arch']
+    if arch_indep:
+        fields.append('Build-Depends-Indep')
+
+    names = []
+    for field in fields:
+        for relation in source.get(field, '').split(','):
+            for alternative in relation.split('|'):
+                match = _RELATION.match(alternative)
+                if not match:
+                    continue
+                name, restrictions, profile_restrictions = match.groups()
+                if _restrictions_match(architecture, restrictions) and \
+                        _profiles_match(profile_restrictions or '', profiles):
+                    if name not in names:
+                        names.append(name)
+                    break
+    return names
+
+
+# Package name, architecture restrictions and build profiles of a relation,
+# eg. ``debhelper:native (>= 9) [!hurd-any] <!nocheck>``.
+_RELATION = re.compile(
+    r'^\s*([a-z0-9][a-z0-9+.-]*)(?::[a-z0-9-]+)?\s*(?:\([^)]*\))?\s*'
+    r'(?:\[([^\]]*)\])?\s*((?:<[^>]*>\s*)*)$')
+
+
+def _restrictions_match(architecture, restrictions):
+    """
+    Check architecture restrictions (eg. ``amd64 i386`` or ``!hurd-any``):
+    one of the architectures must match, or none of the negated ones.
+    """
+    if not restrictions:
+        return True
+    wildcards = restrictions.split()
+    if all(wildcard.startswith('!') for wildcard in wildcards):
+        return not any(architecture_matches(architecture, wildcard[1:])
+                       for wildcard in wildcards)
+    return any(architecture_matches(architecture, wildcard)
+               for wildcard in wildcards if not wildcard.startswith('!'))
+
+
+def get_build_dir(distribution=None):
+    """
+    Get the directory holding the packages built for ``distribution``.
+
+    A matrix build (see :func:`fabric.tasks.package.build.build_matrix`)
+    collects them in ``pkg-build/<distribution>/``, a simple build leaves them
+    in ``pkg-build/``. The directory with the most recent package wins.
+
+    :param distribution: distribution name (like precise, trusty, ...)
+    :type distribution: str
+    :rtype: str
+    """
+    import glob
+
+    def newest(directory):
+        return max([os.path.getmtime(path) for path in
+                    glob.glob(os.path.join(directory, '*.deb'))] or [0])
+
+    if distribution:
+        matrix_dir = os.path.join(BUILD_DIR, distribution)
+        if newest(matrix_dir) > newest(BUILD_DIR):
+            return matrix_dir
+    return BUILD_DIR
+
+
+def get_build_architecture():
+    """
+    Get the Debian architecture of this machine (eg. amd64).
+
+    :rtype: str
+    """
+    return subprocess.check_output(['dpkg', '--print-architecture']).strip()
 
 
 def tag():
     """
     Tag package version.
     """
-    local("git-buildpackage --git-tag-only")
+    try:
+        with trace.stage('helpers.tag'):
+            local("git-buildpackage --git-tag-only")
+    finally:
+        git.invalidate()
 
 
 def new_version(version):
@@ -77,49 +603,53 @@ def new_version(version):
     last_released_version = get_last_version()
 
     if new_release > last_released_version:
-        local('git-dch -R -N {0}'.format(version))
-        local('git commit debian/changelog \\'
-              '-m \'Update changelog for %s release.\'' % version)
+        with trace.stage('helpers.git_dch'):
+            local('git-dch -R -N {0}'.format(version))
+        with trace.stage('helpers.commit_changelog'):
+            local('git commit debian/changelog \\'
+                  '-m \'Update changelog for %s release.\'' % version)
     else:
         abort('New version \'%s\' precedes last released version \'%s\' !' %
               (new_release, last_released_version))
 
 
-def get_last_version():
+def get_last_version(changelog=CHANGELOG):
     """
     Get the last version from the changelog and return it as a
     :class:`Version` instance.
 
+    :param changelog: path to the changelog file.
+    :type changelog: str
     :return: :class:`Version` instance.
     :rtype: Version
     """
-    import re
     from semantic_version import Version
 
-    version_regex = r'[a-zA-Z0-9\-]+\s\((?P<version>.*)\)'
-    version_line = local('head -1 debian/changelog', capture=True)
-    version_match = re.match(version_regex, version_line)
+    head = read_changelog(changelog).head
 
-    if version_match:
-        match_groups = version_match.groupdict()
-        version = Version(match_groups['version'])
-        return version
+    if head:
+        return Version(head.version)
     else:
         raise StandardError('Not able to find a suitable version for this '
                             'project !')
 
 
-def get_distribution_name():
+def get_distribution_name(changelog=CHANGELOG):
     """
     Get the package distribution used to upload in right repository.
 
+    :param changelog: path to the changelog file.
+    :type changelog: str
     :return: distribution name (like precise, trusty, ...)
     :rtype: str, unicode
 
     >>> get_distribution_name() in ('trusty', 'precise')
     True
     """
-    distrib = subprocess.check_output(
-        "head -1 debian/changelog | cut -d';' -f1 | awk '{print $3}'",
-        shell=True)
-    return distrib.strip()
\ No newline at end of file
+    head = read_changelog(changelog).head
+
+    if head and head.distributions:
+        return head.distributions[0]
+    else:
+        raise StandardError('Not able to find the distribution of this '
+                            'project !')
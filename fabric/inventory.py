@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Canux CHENG <canuxcheng@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Servers inventory engine.
+
+Roles are defined by a mapping of role names to entries, each entry being a
+host name or ``@<role>`` to include all the hosts of another role::
+
+    {
+        "central": ["central.example.com"],
+        "workers": ["worker1.example.com", "worker2.example.com"],
+        "ubuntu": ["@central", "@workers"]
+    }
+
+Definitions are loaded from JSON, YAML (needs PyYAML) or INI files. In INI
+files each ``[role]`` section lists one host per line and a
+``[role:children]`` section lists the included roles.
+
+Hosts of a role are kept in definition order without duplicates and a
+reverse index gives the roles of each host. Loaded files are compiled to a
+cache invalidated by the modification time and size of the file.
+"""
+
+import hashlib
+import json
+import marshal
+import os
+from collections import OrderedDict
+
+CACHE_DIR = os.path.expanduser('~/.cache/zfabric/inventory')
+
+# Bump when the compiled format changes.
+CACHE_VERSION = 1
+
+
+class InventoryError(Exception):
+    """Raised for an invalid or unreadable inventory."""
+
+
+class Inventory(object):
+    """Resolved roles with their hosts, and roles of each host."""
+
+    def __init__(self, definitions):
+        """
+        :param definitions: entries (hosts or ``@role``) of each role.
+        :type definitions: dict
+        """
+        self.roles = OrderedDict()
+        for role in sorted(definitions):
+            self._resolve(role, definitions, [])
+
+        self.host_roles = {}
+        for role, hosts in self.roles.items():
+            for host in hosts:
+                self.host_roles.setdefault(host, []).append(role)
+
+    def _resolve(self, role, definitions, stack):
+        if role in self.roles:
+            return self.roles[role]
+        if role in stack:
+            raise InventoryError('Role {0} includes itself: {1}.'.format(
+                role, ' > '.join(stack + [role])))
+        if role not in definitions:
+            raise InventoryError('Unknown role {0} included by {1}.'.format(
+                role, stack[-1]))
+
+        hosts = OrderedDict()
+        for entry in definitions[role] or []:
+            if entry.startswith('@'):
+                included = self._resolve(entry[1:], definitions,
+                                         stack + [role])
+                hosts.update((host, None) for host in included)
+            else:
+                hosts[entry] = None
+
+        self.roles[role] = tuple(hosts)
+        return self.roles[role]
+
+    def hosts(self, *roles):
+        """
+        Get the hosts of one or more roles, without duplicates.
+
+        :rtype: list(str)
+        """
+        hosts = OrderedDict()
+        for role in roles:
+            if role not in self.roles:
+                raise InventoryError('Unknown role {}.'.format(role))
+            hosts.update((host, None) for host in self.roles[role])
+        return list(hosts)
+
+    def roles_of(self, host):
+        """
+        Get the roles a host belongs to.
+
+        :rtype: list(str)
+        """
+        return list(self.host_roles.get(host, ()))
+
+    def roledefs(self):
+        """
+        Get the roles in the format of ``env.roledefs``.
+
+        :rtype: dict
+        """
+        return dict((role, list(hosts)) for role, hosts in self.roles.items())
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an inventory file, using its compiled version if up to date.
+
+        :param path: path to a .json, .yml, .yaml or .ini file.
+        :type path: str
+        :rtype: Inventory
+        """
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            raise InventoryError('Cannot read inventory {0}: {1}.'.format(
+                path, e.strerror))
+        signature = (CACHE_VERSION, path, stat.st_mtime, stat.st_size)
+        cache = os.path.join(CACHE_DIR, '{}.bin'.format(
+            hashlib.sha1(path.encode('utf-8')).hexdigest()))
+
+        try:
+            with open(cache, 'rb') as compiled:
+                cached_signature, roles, host_roles = marshal.load(compiled)
+            if tuple(cached_signature) == signature:
+                inventory = cls.__new__(cls)
+                inventory.roles = OrderedDict(roles)
+                inventory.host_roles = host_roles
+                return inventory
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+
+        inventory = cls(parse(path))
+
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            tmp_path = '{0}.{1}'.format(cache, os.getpid())
+            with open(tmp_path, 'wb') as compiled:
+                marshal.dump((signature, list(inventory.roles.items()),
+                              inventory.host_roles), compiled)
+            os.rename(tmp_path, cache)
+        except (IOError, OSError):
+            # The cache is only an optimisation
+            pass
+
+        return inventory
+
+
+def parse(path):
+    """
+    Read the role definitions of an inventory file.
+
+    :param path: path to a .json, .yml, .yaml or .ini file.
+    :type path: str
+    :return: entries of each role.
+    :rtype: dict
+    """
+    extension = os.path.splitext(path)[1].lower()
+
+    with open(path) as source:
+        if extension == '.json':
+            try:
+                definitions = json.load(source)
+            except ValueError as e:
+                raise InventoryError('Invalid inventory {0}: {1}.'.format(
+                    path, e))
+        elif extension in ('.yml', '.yaml'):
+            try:
+                import yaml
+            except ImportError:
+                raise InventoryError('PyYAML is required to read the '
+                                     'inventory {}.'.format(path))
+            try:
+                definitions = yaml.safe_load(source)
+            except yaml.YAMLError as e:
+                raise InventoryError('Invalid inventory {0}: {1}.'.format(
+                    path, e))
+        elif extension in ('.ini', '.cfg'):
+            definitions = _parse_ini(source)
+        else:
+            raise InventoryError('Unknown inventory format: {}.'.format(path))
+
+    if not isinstance(definitions, dict) or not all(
+            isinstance(entries, (list, type(None)))
+            for entries in definitions.values()):
+        raise InventoryError('Invalid inventory {}: roles must be lists of '
+                             'hosts.'.format(path))
+
+    return definitions
+
+
+def _parse_ini(source):
+    definitions = {}
+    role = None
+
+    for number, line in enumerate(source, 1):
+        line = line.split('#', 1)[0].split(';', 1)[0].strip()
+        if not line:
+            continue
+
+        if line.startswith('[') and line.endswith(']'):
+            section = line[1:-1].strip()
+            children = section.endswith(':children')
+            role = section[:-len(':children')] if children else section
+            definitions.setdefault(role, [])
+        elif role is None:
+            raise InventoryError('Host {0} outside of a role on line '
+                                 '{1}.'.format(line, number))
+        else:
+            # Only the first word, the rest may be host variables
+            entry = line.split()[0]
+            definitions[role].append('@' + entry if children else entry)
+
+    return definitions
@@ -24,15 +24,16 @@
 If this is the first release for a new package, call 'package.release.new'.
 If you need to release a new patch, minor or major release use appropriate task.
 Use 'package.build' to test the building of your package.
+Use 'package.deploy' to install the last version on the servers.
 """
 
 import servers
-from .helpers import package_has_upstream
 from .tasks.package.build import build
 from .tasks.package.util import upload
+from .tasks.package.deploy import deploy
 
-# Detect if the project has an upstream source and load required tasks.
-if not package_has_upstream():
-    from .tasks.package import release
+# Release tasks are always registered, the upstream source detection is done
+# when one of them is run so listing or building never touch the network.
+from .tasks.package import release
 
 print __doc__
@@ -19,19 +19,37 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
 # OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-"""Servers Inventory."""
+"""Servers Inventory.
 
-from fabric.api import env
+The built-in roles below are used unless an inventory file is given with
+``fab --set inventory=<path>`` or the ``ZFABRIC_INVENTORY`` environment
+variable, see :mod:`fabric.inventory` for its format.
+"""
+
+import os
+
+from fabric.api import env, abort
 import textwrap
 
+from fabric.inventory import Inventory, InventoryError
+
 
 # Inventory
 #
 _roles = {
     # Operating systems
-    "debian": [],
-    "ubuntu": [],
-    "redhat": [],
+    "debian": [
+        # Keep compat with old scripts
+        "@ubuntu",
+    ],
+    "ubuntu": [
+        "@central",
+        "@satellites",
+        "@workers",
+    ],
+    "redhat": [
+        "@omnibus",
+    ],
 
     # Groups
     "central": [
@@ -48,21 +66,18 @@ _roles = {
     ],
 }
 
-# Operating Systems
-#
-# Ubuntu
-_roles["ubuntu"].extend(_roles["central"])
-_roles["ubuntu"].extend(_roles["satellites"])
-_roles["ubuntu"].extend(_roles["workers"])
-
-# Debian (keep compat with old scripts)
-_roles["debian"].extend(_roles["ubuntu"])
+_inventory_file = env.get('inventory') or os.environ.get('ZFABRIC_INVENTORY')
 
-# RedHat
-_roles["redhat"].extend(_roles["omnibus"])
+try:
+    if _inventory_file:
+        inventory = Inventory.load(_inventory_file)
+    else:
+        inventory = Inventory(_roles)
+except InventoryError as e:
+    abort(str(e))
 
 # Load inventory in shared fabric env
-env.roledefs.update(_roles)
+env.roledefs.update(inventory.roledefs())
 
 #------------------------------------------------------------------------------
 
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Canux CHENG <canuxcheng@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Run commands streaming their output to a log file.
+
+Builds can print hundreds of megabytes: instead of capturing everything in
+memory or flooding the terminal, :func:`local` writes the whole output to a
+log file line by line, keeps only its last lines in memory and shows a live
+progress line (lines, size, elapsed time and last line)::
+
+    result = stream.local('git-buildpackage', 'pkg-build/build.log')
+
+When the command fails the kept tail is shown with the error, so the reason
+is at hand without opening the log.
+"""
+
+import os
+import subprocess
+import sys
+import time
+from collections import deque
+
+from fabric.api import env
+from fabric.state import output
+from fabric.utils import error
+
+# Number of last output lines kept in memory, see env.stream_tail.
+TAIL_LINES = 100
+
+# Seconds between two progress updates on a terminal, and in other outputs.
+PROGRESS_INTERVAL = 0.5
+PROGRESS_INTERVAL_LOG = 30
+
+
+class StreamResult(object):
+    """Outcome of a streamed command."""
+
+    def __init__(self, command, log, return_code, lines, size, duration,
+                 tail):
+        self.command = command
+        self.log = log
+        self.return_code = return_code
+        self.lines = lines
+        self.size = size
+        self.duration = duration
+        self.tail = tail
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+    @property
+    def failed(self):
+        return not self.succeeded
+
+
+class _LineSink(object):
+    """
+    File-like object receiving the output: written to the log, last lines
+    kept, progress shown.
+    """
+
+    def __init__(self, host, label, log_file, tail, progress):
+        self.host = host
+        self.label = label
+        self.log_file = log_file
+        self.tail = deque(maxlen=tail)
+        self.partial = ''
+        self.lines = 0
+        self.size = 0
+        self.start = time.time()
+
+        self.progress = progress and output.running
+        self.interactive = sys.stdout.isatty()
+        self.interval = PROGRESS_INTERVAL if self.interactive \
+            else PROGRESS_INTERVAL_LOG
+        self.shown = self.start
+
+    def write(self, data):
+        self.log_file.write(data)
+        self.size += len(data)
+
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        self.lines += len(lines)
+        self.tail.extend(lines)
+
+        if self.progress and time.time() - self.shown >= self.interval:
+            self.show()
+
+    def flush(self):
+        self.log_file.flush()
+
+    def close(self):
+        if self.partial:
+            self.lines += 1
+            self.tail.append(self.partial)
+            self.partial = ''
+        if self.progress and self.interactive:
+            # Leave the last state on screen
+            self.show()
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+
+    def show(self):
+        self.shown = time.time()
+        status = '[{0}] {1}: {2} lines, {3:.1f} MiB, {4:.0f}s'.format(
+            self.host, self.label, self.lines,
+            self.size / 1048576.0, self.shown - self.start)
+        if self.tail:
+            status += ': ' + self.tail[-1].strip()
+
+        if self.interactive:
+            sys.stdout.write('\r\033[K' + status[:_terminal_width() - 1])
+        else:
+            sys.stdout.write(status + '\n')
+        sys.stdout.flush()
+
+
+def _terminal_width():
+    try:
+        return int(os.environ.get('COLUMNS', 80))
+    except ValueError:
+        return 80
+
+
+def _open_log(log):
+    directory = os.path.dirname(log)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    return open(log, 'wb')
+
+
+def _finish(which, sink, command, log, return_code, warn_only):
+    sink.close()
+    result = StreamResult(command, log, return_code, sink.lines, sink.size,
+                          time.time() - sink.start, list(sink.tail))
+
+    if result.failed and not warn_only:
+        message = '{0}() encountered an error (return code {1}) while ' \
+                  'executing \'{2}\''.format(which, return_code, command)
+        if result.tail:
+            message += '\n\nLast {0} line(s) of {1}:\n{2}'.format(
+                len(result.tail), log, '\n'.join(result.tail))
+        error(message)
+    return result
+
+
+def local(command, log, tail=None, progress=True, warn_only=False):
+    """
+    Run a local command, its standard and error outputs going to ``log``.
+
+    :param command: shell command, or arguments list run without a shell.
+    :type command: str, list
+    :param log: path of the log file, replaced.
+    :type log: str
+    :param tail: number of last lines kept, default to ``env.stream_tail``
+                 or :data:`TAIL_LINES`.
+    :type tail: int
+    :param progress: show a progress line.
+    :type progress: bool
+    :param warn_only: return a failed result instead of aborting.
+    :type warn_only: bool
+    :rtype: StreamResult
+    """
+    label = command if isinstance(command, basestring) else command[0]
+    if output.running:
+        print('[localhost] local: {0} > {1}'.format(label, log))
+
+    with _open_log(log) as log_file:
+        sink = _LineSink('localhost', label, log_file,
+                         int(tail or env.get('stream_tail', TAIL_LINES)),
+                         progress)
+        process = subprocess.Popen(
+            command, shell=isinstance(command, basestring),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        # Read what is available instead of line by line, much faster with
+        # verbose builds
+        for data in iter(lambda: os.read(process.stdout.fileno(), 65536),
+                         b''):
+            sink.write(data)
+        process.stdout.close()
+        return _finish('local', sink, command, log, process.wait(),
+                       warn_only)
+
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Canux CHENG <canuxcheng@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Tasks acting on many servers at once."""
+
+import multiprocessing
+import Queue
+import signal
+import time
+from collections import OrderedDict
+
+from fabric.api import env, task, settings, hide, run, sudo, puts, abort
+from fabric.colors import yellow, green, red
+from fabric.exceptions import CommandTimeout
+from fabric.network import disconnect_all
+
+from fabric import helpers, trace
+
+# Hosts handled at once by default, see command().
+FLEET_POOL_SIZE = 50
+
+# Seconds to connect to a host and to run the command, see command().
+FLEET_TIMEOUT = 10
+
+# Hosts listed by group in the report, the others are counted.
+REPORT_HOSTS = 10
+
+# Output lines shown by group in the report.
+REPORT_LINES = 20
+
+
+class FleetError(Exception):
+    """Raised instead of aborting while running a command on one host."""
+
+
+def _init_worker():
+    # Ctrl+C is handled by the parent, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _on_host(job):
+    """
+    Run a command on one host, in a pool process.
+
+    :param job: host, command, timeout and whether to use sudo.
+    :type job: tuple
+    :return: host, status (ok, failed, timeout or error), output and
+             duration.
+    :rtype: dict
+    """
+    host, command, timeout, use_sudo = job
+    start = time.time()
+    try:
+        with settings(hide('everything'), host_string=host, host=host,
+                      timeout=timeout, abort_on_prompts=True,
+                      abort_exception=FleetError, warn_only=True):
+            result = (sudo if use_sudo else run)(command, pty=False,
+                                                 timeout=timeout)
+        status = 'ok' if result.succeeded else 'failed'
+        output = result.stdout
+    except CommandTimeout:
+        status, output = 'timeout', 'No answer after {}s.'.format(timeout)
+    except Exception as e:
+        status, output = 'error', str(e) or e.__class__.__name__
+    finally:
+        # A pool process handles many hosts, do not keep them all connected
+        disconnect_all()
+    return {
+        'host': host,
+        'status': status,
+        'output': output.strip(),
+        'duration': time.time() - start,
+    }
+
+
+def dispatch(hosts, command, size, timeout, use_sudo=False, batch=False,
+             stop=None):
+    """
+    Run a command on ``hosts``, in a pool of ``size`` processes.
+
+    A new host is started as soon as one is done (sliding window), or once
+    the whole previous batch of ``size`` hosts is done if ``batch`` is true.
+    No host is started anymore once ``stop()`` is true, the ones running go
+    on to the end.
+
+    :param hosts: hosts to run the command on.
+    :type hosts: list(str)
+    :param command: shell command to run.
+    :type command: str
+    :param size: maximum number of hosts handled at once.
+    :type size: int
+    :param timeout: seconds to connect and run the command on a host.
+    :type timeout: int
+    :param use_sudo: run the command with sudo.
+    :type use_sudo: bool
+    :param batch: start the hosts by batches of ``size``.
+    :type batch: bool
+    :param stop: called before starting a host, stops when true.
+    :type stop: callable
+    :return: the outcome of every host started, as they are done, see
+             :func:`_on_host`.
+    :rtype: generator
+    """
+    done = Queue.Queue()
+    pending = iter(hosts)
+    running = 0
+    # Hosts started in the current batch
+    started = 0
+    pool = multiprocessing.Pool(min(size, len(hosts)), _init_worker)
+    try:
+        while True:
+            if batch and not running:
+                started = 0
+            while (started if batch else running) < size and \
+                    not (stop and stop()):
+                host = next(pending, None)
+                if host is None:
+                    break
+                pool.apply_async(_on_host,
+                                 ((host, command, timeout, use_sudo),),
+                                 callback=done.put)
+                running += 1
+                started += 1
+            if not running:
+                break
+
+            # Wait with a timeout, or Ctrl+C is not seen until it returns
+            while True:
+                try:
+                    result = done.get(True, 1)
+                    break
+                except Queue.Empty:
+                    pass
+            running -= 1
+            yield result
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def select_hosts(roles, hosts):
+    """
+    Get the hosts of ``roles`` and ``hosts`` (separated by ``;``), once
+    each, in order. Aborts on an unknown role.
+
+    :param roles: roles of the servers inventory.
+    :type roles: str
+    :param hosts: other hosts.
+    :type hosts: str
+    :rtype: list(str)
+    """
+    selected = OrderedDict()
+    for role in (roles or '').split(';'):
+        if not role:
+            continue
+        if role not in env.roledefs:
+            abort('Unknown role \'{0}\', use one of: {1}.'.format(
+                role, ', '.join(sorted(env.roledefs))))
+        for host in env.roledefs[role]:
+            selected[host] = True
+    for host in (hosts or '').split(';'):
+        if host:
+            selected[host] = True
+    return list(selected)
+
+
+def show_result(result):
+    """
+    Show the outcome of one host as soon as it is known.
+
+    :param result: outcome of the host, see :func:`dispatch`.
+    :type result: dict
+    """
+    color = green if result['status'] == 'ok' else red
+    lines = result['output'].splitlines()
+    puts(color('{0}: {1} ({2:.1f}s) {3}'.format(
+        result['host'], result['status'], result['duration'],
+        lines[0] if lines else '').rstrip()), show_prefix=False)
+
+
+def report(command, results, duration):
+    """
+    Show the outcomes, hosts with the same status and output together.
+
+    :param command: what was run, for the title.
+    :type command: str
+    :param results: outcome of every host, see :func:`dispatch`.
+    :type results: list(dict)
+    :param duration: seconds it took.
+    :type duration: float
+    """
+    groups = OrderedDict()
+    for result in sorted(results, key=lambda result: result['host']):
+        groups.setdefault((result['status'], result['output']), []).append(
+            result['host'])
+
+    counts = OrderedDict()
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+
+    puts('', show_prefix=False)
+    puts('\'{0}\' on {1} host(s) in {2:.1f}s: {3}.'.format(
+        command, len(results), duration, ', '.join(
+            '{0} {1}'.format(count, status)
+            for status, count in counts.items())), show_prefix=False)
+
+    for (status, output), hosts in sorted(
+            groups.items(), key=lambda group: -len(group[1])):
+        color = green if status == 'ok' else red
+        listed = ', '.join(hosts[:REPORT_HOSTS])
+        if len(hosts) > REPORT_HOSTS:
+            listed += ', ... (+{})'.format(len(hosts) - REPORT_HOSTS)
+        puts('', show_prefix=False)
+        puts(color('{0} host(s) {1}: {2}'.format(len(hosts), status,
+                                                 listed)),
+             show_prefix=False)
+
+        lines = output.splitlines()
+        for line in lines[:REPORT_LINES]:
+            puts('    {}'.format(line), show_prefix=False)
+        if len(lines) > REPORT_LINES:
+            puts(yellow('    ... {} more line(s)'.format(
+                len(lines) - REPORT_LINES)), show_prefix=False)
+
+
+@task
+def command(command, roles=None, hosts=None, pool_size=None, timeout=None,
+            stream=True):
+    """
+    Run a command on every host of ``roles`` and ``hosts`` (both separated
+    by ``;``), at most ``pool_size`` at once, eg.
+    ``fab fleet.command:"uptime",roles="workers;satellites"``.
+
+    The outcome of each host is shown as soon as it is known (unless
+    ``stream`` is false), then a report groups the hosts with the same
+    output.
+
+    :param command: shell command to run.
+    :type command: str
+    :param roles: roles of the servers inventory.
+    :type roles: str
+    :param hosts: other hosts.
+    :type hosts: str
+    :param pool_size: maximum number of hosts handled at once.
+    :type pool_size: int
+    :param timeout: seconds to connect and run the command on a host.
+    :type timeout: int
+    :param stream: show each host outcome as it arrives.
+    :type stream: bool
+    :return: host, status, output and duration of every host.
+    :rtype: list(dict)
+    """
+    selected = select_hosts(roles, hosts)
+    if not selected:
+        abort('No host selected, give roles or hosts !')
+
+    pool_size = int(pool_size or env.get('fleet_pool_size', FLEET_POOL_SIZE))
+    timeout = int(timeout or env.get('fleet_timeout', FLEET_TIMEOUT))
+    stream = helpers.is_true(stream)
+
+    puts(green('Running \'{0}\' on {1} host(s), {2} at once...'.format(
+        command, len(selected), min(pool_size, len(selected)))))
+
+    start = time.time()
+    results = []
+    try:
+        with trace.stage('fleet.command'):
+            # Results come in the order the hosts answer
+            for result in dispatch(selected, command, pool_size, timeout):
+                results.append(result)
+                if stream:
+                    show_result(result)
+    except KeyboardInterrupt:
+        abort('Interrupted, {0} of {1} host(s) done.'.format(
+            len(results), len(selected)))
+
+    report(command, results, time.time() - start)
+    return results
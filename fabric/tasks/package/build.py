@@ -21,14 +21,238 @@
 
 """Testing utilities for package building."""
 
-from fabric.api import task, local, puts
-from fabric.colors import cyan
+import glob
+import os
+import shutil
+import time
+from multiprocessing.pool import ThreadPool
+
+from fabric.api import task, puts, abort
+from fabric.colors import cyan, green, red
+
+from fabric import buildcache, chroot, helpers, stream, trace
+
+# Files produced by a build that are collected into the distribution directory.
+BUILD_RESULTS = ('*.deb', '*.udeb', '*.changes', '*.dsc', '*.tar.*')
+
+# Last lines of the log shown for each failed target of a matrix build.
+MATRIX_TAIL_LINES = 20
+
+
+def _collect(directory, since):
+    """
+    Find the build results written in ``directory`` after ``since``.
+
+    :rtype: list(str)
+    """
+    return [path for pattern in BUILD_RESULTS
+            for path in glob.glob(os.path.join(directory, pattern))
+            if os.path.getmtime(path) >= since]
 
 
 @task
-def build():
+def build(distributions=None, architectures=None, pool_size=None,
+          use_cache=True, use_chroot=False):
     """
     Build the package. Use this for testing package construction.
+
+    Results are cached on the git tree, version, distribution and
+    architecture (see :mod:`fabric.buildcache`): building an unchanged tree
+    again restores them instead. Set ``use_cache`` to no to always build.
+
+    Giving ``distributions`` and/or ``architectures`` (separated by ``;``)
+    builds every combination concurrently in pbuilder, eg.
+    ``fab package.build:distributions="precise;trusty"``. See
+    :func:`build_matrix`.
+
+    Set ``use_chroot`` to yes to build in cowbuilder chroots keeping the
+    build dependencies installed while ``Build-Depends`` does not change
+    (see :mod:`fabric.chroot`).
+
+    :param distributions: distributions to build for.
+    :type distributions: str
+    :param architectures: architectures to build for.
+    :type architectures: str
+    :param pool_size: maximum number of concurrent builds.
+    :type pool_size: int
+    :param use_cache: reuse and store results in the build cache.
+    :type use_cache: bool
+    :param use_chroot: build in a reusable chroot.
+    :type use_chroot: bool
     """
+    use_cache = helpers.is_true(use_cache)
+    use_chroot = helpers.is_true(use_chroot)
+
+    if distributions or architectures:
+        build_matrix(
+            distributions.split(';') if distributions else None,
+            architectures.split(';') if architectures else None,
+            int(pool_size) if pool_size else None,
+            use_cache, use_chroot)
+        return
+
+    distribution = helpers.get_distribution_name()
+    architecture = helpers.get_build_architecture()
+
+    key = None
+    if use_cache:
+        key = buildcache.get_key(distribution, architecture)
+        if buildcache.restore(key, helpers.BUILD_DIR):
+            puts(green('Package restored from the build cache.'))
+            return
+
+    log = os.path.join(helpers.BUILD_DIR, 'build.log')
     puts(cyan('Building the package...'))
-    local("git-buildpackage")
\ No newline at end of file
+    start = time.time()
+    if use_chroot:
+        with chroot.snapshot(distribution, architecture) as basepath:
+            with trace.stage('build.git_buildpackage'):
+                stream.local(['git-buildpackage', chroot.get_builder(
+                    distribution, architecture, basepath, helpers.BUILD_DIR)],
+                    log)
+    else:
+        with trace.stage('build.git_buildpackage'):
+            stream.local('git-buildpackage', log)
+    buildcache.store(key, _collect(helpers.BUILD_DIR, start))
+
+
+def build_matrix(distributions=None, architectures=None, pool_size=None,
+                 use_cache=True, use_chroot=False):
+    """
+    Build the package for every distribution and architecture combination.
+
+    Each target runs its own ``git-buildpackage --git-pbuilder`` with a
+    private export directory and a log file, at most ``pool_size`` at the
+    same time. Results are collected in ``pkg-build/<distribution>/``.
+    Architecture independent packages are only built with the first
+    architecture of each distribution. With ``use_chroot``, pbuilder is
+    replaced by the reusable chroots of :mod:`fabric.chroot`.
+
+    :param distributions: distributions to build for, default to the one of
+                          the changelog.
+    :type distributions: list(str)
+    :param architectures: architectures to build for, default to the one of
+                          this machine.
+    :type architectures: list(str)
+    :param pool_size: maximum number of concurrent builds, default to the
+                      number of targets.
+    :type pool_size: int
+    :param use_cache: reuse and store results in the build cache.
+    :type use_cache: bool
+    :param use_chroot: build in reusable chroots.
+    :type use_chroot: bool
+    """
+    distributions = distributions or [helpers.get_distribution_name()]
+    architectures = architectures or [helpers.get_build_architecture()]
+
+    for distribution in distributions:
+        if distribution not in helpers.SUPPORTED_DISTRIBUTIONS:
+            abort('The distribution {} is not supported ! Aborting.'.format(
+                distribution))
+
+    targets = []
+    for distribution in distributions:
+        for architecture in architectures:
+            with_indep = architecture == architectures[0]
+            key = None
+            if use_cache:
+                # Architecture only builds do not give the same results
+                key = buildcache.get_key(distribution, architecture if
+                                         with_indep else architecture + '-B')
+            if buildcache.restore(key, os.path.join(helpers.BUILD_DIR,
+                                                    distribution)):
+                puts(green('{0}/{1}: restored from the build cache.'.format(
+                    distribution, architecture)))
+                continue
+            targets.append((distribution, architecture, with_indep, key,
+                            use_chroot))
+
+    if not targets:
+        return
+
+    pool_size = pool_size or len(targets)
+
+    puts(cyan('Building the package for {0} target(s), {1} at a time...'
+              .format(len(targets), pool_size)))
+
+    pool = ThreadPool(pool_size)
+    try:
+        results = pool.map(_build_target, targets)
+    finally:
+        pool.close()
+        pool.join()
+
+    matrix_dir = os.path.join(helpers.BUILD_DIR, '.matrix')
+    if os.path.isdir(matrix_dir) and not os.listdir(matrix_dir):
+        os.rmdir(matrix_dir)
+
+    failed = []
+    for distribution, architecture, result in results:
+        if result.succeeded:
+            puts(green('{0}/{1}: built in {2:.0f}s.'.format(
+                distribution, architecture, result.duration)))
+        else:
+            puts(red('{0}/{1}: failed after {2:.0f}s, see {3}:\n{4}'.format(
+                distribution, architecture, result.duration, result.log,
+                '\n'.join(result.tail[-MATRIX_TAIL_LINES:]))))
+            failed.append(result.log)
+
+    if failed:
+        abort('{} build(s) failed !'.format(len(failed)))
+
+
+def _build_target(target):
+    """
+    Build one target of the matrix, run by the worker threads.
+
+    :return: distribution, architecture and outcome of the build.
+    :rtype: tuple
+    """
+    distribution, architecture, with_indep, key, use_chroot = target
+
+    result_dir = os.path.join(helpers.BUILD_DIR, distribution)
+    export_dir = os.path.join(
+        helpers.BUILD_DIR, '.matrix', '{0}_{1}'.format(
+            distribution, architecture))
+    log = os.path.join(result_dir, 'build_{}.log'.format(architecture))
+
+    if os.path.isdir(export_dir):
+        shutil.rmtree(export_dir)
+    for path in (export_dir, result_dir):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    # The tree is exported, so do not let concurrent builds clean the
+    # working copy. Extra arguments are passed to dpkg-buildpackage.
+    command = [
+        'git-buildpackage',
+        '--git-cleaner=true',
+        '--git-export-dir={}'.format(export_dir),
+    ]
+
+    # Concurrent progress lines would garble each other
+    start = time.time()
+    if use_chroot:
+        with chroot.snapshot(distribution, architecture, with_indep,
+                             result_dir) as basepath:
+            command.append(chroot.get_builder(
+                distribution, architecture, basepath, export_dir,
+                with_indep))
+            result = stream.local(command, log, progress=False,
+                                  warn_only=True)
+    else:
+        command.extend(['--git-pbuilder',
+                        '--git-dist={}'.format(distribution),
+                        '--git-arch={}'.format(architecture)])
+        if not with_indep:
+            command.append('-B')
+        result = stream.local(command, log, progress=False, warn_only=True)
+
+    if result.succeeded:
+        results = _collect(export_dir, start)
+        for path in results:
+            shutil.copy2(path, result_dir)
+        buildcache.store(key, results)
+        shutil.rmtree(export_dir)
+
+    return distribution, architecture, result
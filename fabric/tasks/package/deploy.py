@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Canux CHENG <canuxcheng@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Tasks to roll out a released version on the servers."""
+
+import pipes
+import time
+
+from fabric.api import task, puts, abort
+from fabric.colors import green, red, yellow
+from fabric.contrib.console import confirm
+
+from fabric import helpers, trace
+from fabric.tasks import fleet
+
+# Hosts upgraded at once by default, see deploy().
+DEPLOY_WINDOW = 10
+
+# Seconds allowed to update the indexes and install on a host.
+DEPLOY_TIMEOUT = 600
+
+INSTALL_COMMAND = ('apt-get update -qq && DEBIAN_FRONTEND=noninteractive '
+                   'apt-get install -qq -y {}')
+
+
+def _failure_threshold(max_failures, hosts):
+    """
+    Get the number of failed hosts a deployment tolerates, ``max_failures``
+    being a number or a percentage of ``hosts`` (eg. ``5%``).
+
+    :rtype: int
+    """
+    try:
+        if str(max_failures).endswith('%'):
+            return int(float(str(max_failures)[:-1]) * hosts / 100)
+        return int(max_failures)
+    except ValueError:
+        abort('Invalid failure threshold \'{}\' !'.format(max_failures))
+
+
+@task
+def deploy(roles='workers', hosts=None, packages=None, window=None,
+           batch=False, max_failures=0, timeout=None):
+    """
+    Install the last version of the changelog on the servers, eg.
+    ``fab package.deploy:roles="workers;satellites",window=20``.
+
+    The hosts of ``roles`` and ``hosts`` (both separated by ``;``) update
+    their indexes and install the binary packages (or only ``packages``) at
+    this version, ``window`` hosts at a time: a new host starts as soon as
+    one is done, or once the whole batch is done if ``batch`` is true. When
+    more than ``max_failures`` hosts (a number or a percentage) failed, no
+    host is started anymore.
+
+    :param roles: roles of the servers inventory.
+    :type roles: str
+    :param hosts: other hosts.
+    :type hosts: str
+    :param packages: binary packages to install, default to all.
+    :type packages: str
+    :param window: maximum number of hosts upgraded at once.
+    :type window: int
+    :param batch: upgrade ``window`` hosts, then the next ones...
+    :type batch: bool
+    :param max_failures: failed hosts tolerated.
+    :type max_failures: str
+    :param timeout: seconds allowed to install on a host.
+    :type timeout: int
+    :return: host, status, output and duration of every host started.
+    :rtype: list(dict)
+    """
+    version = str(helpers.get_last_version())
+    if packages:
+        packages = [package for package in packages.split(';') if package]
+    else:
+        packages = helpers.get_package_list()
+    if not packages:
+        abort('No binary package found in debian/control ! Aborting.')
+
+    selected = fleet.select_hosts(roles, hosts)
+    if not selected:
+        abort('No host selected, give roles or hosts !')
+
+    window = int(window or DEPLOY_WINDOW)
+    timeout = int(timeout or DEPLOY_TIMEOUT)
+    batch = helpers.is_true(batch)
+    threshold = _failure_threshold(max_failures, len(selected))
+
+    puts('\n\nYou are about to install package(s): {}'.format(
+        ', '.join(packages)))
+    puts('The version is: {}'.format(version))
+    puts('On {0} host(s), {1} {2}, stopping after {3} failure(s).'.format(
+        len(selected), window, 'by batch' if batch else 'at once',
+        threshold + 1))
+
+    answer = confirm(red('Ready to deploy ?', bold=True), default=False)
+    if not answer or answer == 'no':
+        abort('Aborting. Deployment is cancelled.')
+
+    command = INSTALL_COMMAND.format(' '.join(
+        pipes.quote('{0}={1}'.format(package, version))
+        for package in packages))
+
+    start = time.time()
+    results, failed = [], []
+    try:
+        with trace.stage('deploy.install'):
+            for result in fleet.dispatch(
+                    selected, command, window, timeout, use_sudo=True,
+                    batch=batch, stop=lambda: len(failed) > threshold):
+                results.append(result)
+                if result['status'] != 'ok':
+                    failed.append(result['host'])
+                fleet.show_result(result)
+    except KeyboardInterrupt:
+        abort('Interrupted, {0} of {1} host(s) done.'.format(
+            len(results), len(selected)))
+
+    fleet.report('deploy {}'.format(version), results, time.time() - start)
+
+    if len(failed) > threshold:
+        abort('Deployment stopped after {0} failure(s), {1} host(s) not '
+              'deployed !'.format(len(failed), len(selected) - len(results)))
+    elif failed:
+        puts(yellow('Deployed, {0} host(s) failed: {1}.'.format(
+            len(failed), ', '.join(sorted(failed)))))
+    else:
+        puts(green('Version {0} deployed on {1} host(s).'.format(
+            version, len(results))))
+    return results
@@ -21,18 +21,232 @@
 
 """Tasks to release a new version."""
 
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from functools import wraps
+
 from fabric import helpers
 
 from fabric.api import *
 from fabric.colors import *
 from fabric.contrib.console import confirm
 
-from fabric import git
+from fabric import git, trace
+
+
+def native_only(func):
+    """
+    Decorator aborting a release task if the package has an upstream source.
+
+    The upstream detection needs a round-trip to the remote repository, so it
+    is only done when the task is actually run (and cached, see
+    :func:`fabric.helpers.package_has_upstream`).
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if helpers.package_has_upstream():
+            abort('This package has an upstream source (pristine-tar branch '
+                  'found on origin), release tasks are not available !')
+        return func(*args, **kwargs)
+    return wrapper
+
+
+class ReleaseContext(object):
+    """
+    What a release needs to know about the repository, gathered once by
+    :func:`preflight` before any change is made.
+    """
+
+    def __init__(self, state, distribution, last_version, packages):
+        """
+        :param state: refs of the repository, fetched from origin.
+        :type state: fabric.git.RepoState
+        :param distribution: target distribution, from the changelog.
+        :type distribution: str
+        :param last_version: last version of the changelog.
+        :type last_version: Version
+        :param packages: names of the binary packages.
+        :type packages: list(str)
+        """
+        self.state = state
+        self.distribution = distribution
+        self.last_version = last_version
+        self.packages = packages
+
+    def has_tag(self, tagname=None):
+        """Same as :func:`fabric.git.has_tag`, from the fetched refs."""
+        return self.state.has_tag(tagname)
+
+    def validate(self):
+        """Abort if the package cannot be released."""
+        if self.distribution not in helpers.SUPPORTED_DISTRIBUTIONS:
+            abort('The distribution {} is not supported ! Aborting.'.format(
+                self.distribution))
+        if not self.packages:
+            abort('No binary package found in debian/control ! Aborting.')
+
+
+def _fetch_state():
+    """Fetch the tags from origin and read the refs."""
+    git.fetch()
+    return git.get_state()
+
+
+# Pre-flight probes of a release: context attribute and function.
+PREFLIGHT_PROBES = (
+    ('state', _fetch_state),
+    ('distribution', helpers.get_distribution_name),
+    ('last_version', helpers.get_last_version),
+    ('packages', helpers.get_package_list),
+)
+
+
+def _probe(name, func, results):
+    try:
+        with trace.stage('preflight.{}'.format(name)):
+            results[name] = func(), None
+    except SystemExit:
+        # abort() already told why, do not end the thread silently
+        results[name] = None, 'aborted'
+    except Exception as e:
+        results[name] = None, str(e) or e.__class__.__name__
+
+
+def preflight():
+    """
+    Run the read-only checks of a release (fetch and refs, distribution,
+    last version and package list) concurrently, each one in its own thread,
+    so they take as long as the slowest one.
+
+    :return: the validated context.
+    :rtype: ReleaseContext
+    """
+    results = {}
+    threads = [threading.Thread(target=_probe, args=(name, func, results))
+               for name, func in PREFLIGHT_PROBES]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    errors = ['{0}: {1}'.format(name, results[name][1])
+              for name, _ in PREFLIGHT_PROBES if results[name][1]]
+    if errors:
+        abort('Pre-flight checks failed !\n  {}'.format('\n  '.join(errors)))
+
+    context = ReleaseContext(**dict(
+        (name, value) for name, (value, _) in results.items()))
+    context.validate()
+    return context
+
+
+# Progress of a release, kept out of the working copy, see Checkpoint.
+CHECKPOINT = '.git/zfabric-release-{}.json'
+
+# Stages of a release, in order.
+RELEASE_STAGES = ('distclean', 'new_version', 'tag', 'build', 'push',
+                  'upload')
 
-from semantic_version import Version
+
+class Checkpoint(object):
+    """
+    Stages of the release of a version already done and the files built, so
+    running the release again after a failure resumes it instead of
+    starting over.
+    """
+
+    def __init__(self, version):
+        """
+        :param version: version released.
+        :type version: str
+        """
+        self.version = str(version)
+        self.path = CHECKPOINT.format(self.version)
+        self.stages = []
+        self.artifacts = {}
+        try:
+            with open(self.path) as checkpoint_file:
+                saved = json.load(checkpoint_file)
+            self.stages = saved['stages']
+            self.artifacts = dict(
+                (name, tuple(artifact))
+                for name, artifact in saved['artifacts'].items())
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    @classmethod
+    def exists(cls, version):
+        """Tell if a release of ``version`` is unfinished."""
+        return os.path.exists(CHECKPOINT.format(version))
+
+    def done(self, stage):
+        return stage in self.stages
+
+    def complete(self, stage, artifacts=None):
+        """Record that ``stage`` is done, with the files it built."""
+        if not self.done(stage):
+            self.stages.append(stage)
+        if artifacts is not None:
+            self.artifacts = artifacts
+        self._save()
+
+    def reset(self, stage):
+        """Forget ``stage`` and the stages after it."""
+        self.stages = [
+            done for done in self.stages
+            if RELEASE_STAGES.index(done) < RELEASE_STAGES.index(stage)]
+        self._save()
+
+    def verify_artifacts(self):
+        """
+        Check that the files built are still there, unchanged.
+
+        :return: False if one is missing or differs, or nothing was built.
+        :rtype: bool
+        """
+        if not self.artifacts:
+            return False
+        for path, checksum in self.artifacts.values():
+            if not os.path.isfile(path) or \
+                    helpers.file_checksum(path) != checksum:
+                return False
+        return True
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _save(self):
+        tmp_path = '{0}.{1}'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump({'version': self.version, 'stages': self.stages,
+                       'artifacts': self.artifacts}, checkpoint_file,
+                      indent=2)
+        os.rename(tmp_path, self.path)
+
+
+def _resume(last_version):
+    """
+    Resume the unfinished release of ``last_version``, if any: the changelog
+    already has it, bumping it again would skip a version.
+
+    :return: True if the release was resumed.
+    :rtype: bool
+    """
+    if not Checkpoint.exists(last_version):
+        return False
+    puts(yellow('The release of {} is unfinished, resuming it.'.format(
+        last_version)))
+    execute(new, str(last_version))
+    return True
 
 
 @task
+@native_only
 def new(version_string=None):
     """
     Release a brand new package version or specified.
@@ -40,73 +254,114 @@ def new(version_string=None):
     If ``version_string`` is None, this may be because this is the first
     release.
 
+    The stages done are recorded in a checkpoint (see :class:`Checkpoint`),
+    if the release fails, running it again resumes at the first stage not
+    done and reuses the packages built when they did not change.
+
     :param version_string: this is the version to release (eg. 1.0.5)
     :type version_string: str
     """
+    from semantic_version import Version
     from .build import build
     import util
 
-    # Ensure that all tags are downloaded from remote
-    git.fetch()
+    # Ensure that all tags are downloaded from remote, and read what the
+    # release needs meanwhile
+    with trace.stage('release.preflight'):
+        context = preflight()
+    distribution = context.distribution
 
     version = None
-    distribution = helpers.get_distribution_name()
-
     try:
         if version_string:
             version = Version(version_string)
         else:
-            if git.has_tag():
+            # The tag of an interrupted first release is already there
+            if Checkpoint.exists(context.last_version):
+                version = context.last_version
+            elif context.has_tag():
                 abort('You must specify a new version !')
             else:
-                version = helpers.get_last_version()
+                version = context.last_version
     except ValueError:
         abort('The version specified \'%s\' is not Semantic Versioning !' %
               version_string)
 
-    puts(green(
-        'Releasing a new package: v{0} for {1}.'.format(
-            version, distribution), bold=True))
+    checkpoint = Checkpoint(version)
+    if checkpoint.stages:
+        puts(yellow('Resuming the release of {0}, done: {1}.'.format(
+            version, ', '.join(checkpoint.stages))))
+    else:
+        puts(green(
+            'Releasing a new package: v{0} for {1}.'.format(
+                version, distribution), bold=True))
 
-    # Exit if specified version already exist
-    if version_string and git.has_tag(str(version)):
-        abort('Error: version \'%s\' already exist !' % version)
+        # Exit if specified version already exist
+        if version_string and context.has_tag(str(version)):
+            abort('Error: version \'%s\' already exist !' % version)
 
     # Clean working copy
-    local('make distclean')
+    if not checkpoint.done('distclean'):
+        with trace.stage('release.distclean'):
+            local('make distclean')
+        checkpoint.complete('distclean')
 
     # Create the version in changelog if tags are found
-    if version_string and git.has_tag():
-        helpers.new_version(str(version))
+    if not checkpoint.done('new_version'):
+        if version_string and context.has_tag():
+            with trace.stage('release.new_version'):
+                helpers.new_version(str(version))
+        checkpoint.complete('new_version')
 
     # Tag the release
-    if not git.has_tag(str(version)):
-        helpers.tag()
-
-    # Build package
-    build()
-
-    # Confirm before pushing centrally
+    if not checkpoint.done('tag'):
+        if not context.has_tag(str(version)):
+            with trace.stage('release.tag'):
+                helpers.tag()
+        checkpoint.complete('tag')
+
+    # Build package, unless the packages built are still there
+    if checkpoint.done('build') and not checkpoint.verify_artifacts():
+        puts(yellow('The packages built changed or are missing, '
+                    'building again.'))
+        checkpoint.reset('build')
+    if not checkpoint.done('build'):
+        with trace.stage('release.build'):
+            build()
+        build_dir = os.path.abspath(helpers.get_build_dir(distribution))
+        checkpoint.complete('build', util.local_artifacts(
+            build_dir, context.packages))
+
+    # Confirm before pushing centrally, unless already pushed
     # Summary of changes
-    puts('\n\nYou are about to push package(s): {}'.format(", ".join(
-        helpers.get_package_list())))
-    puts('The new version is: {}'.format(version))
-    puts('The target distribution is: {}'.format(distribution))
+    packages = context.packages
+    if not checkpoint.done('push'):
+        puts('\n\nYou are about to push package(s): {}'.format(", ".join(
+            packages)))
+        puts('The new version is: {}'.format(version))
+        puts('The target distribution is: {}'.format(distribution))
+
+        answer = confirm(red(
+            'Last chance before pushing centrally, are you ready ?',
+            bold=True), default=False)
+        if not answer or answer == 'no':
+            puts(yellow('Deleting local tag.'))
+            git.delete_tag(version)
+            checkpoint.remove()
+            abort('Aborting. Pushing is cancelled.')
 
-    answer = confirm(red(
-        'Last chance before pushing centrally, are you ready ?',
-        bold=True), default=False)
-    if not answer or answer == 'no':
-        puts(yellow('Deleting local tag.'))
-        local('git tag -d {}'.format(version))
-        abort('Aborting. Pushing is cancelled.')
-    else:
         # Push commits and DEB package
-        git.push()
-        execute(util.upload, distribution)
+        with trace.stage('release.push'):
+            git.push()
+        checkpoint.complete('push')
+
+    with trace.stage('release.upload'):
+        util.upload_artifacts(distribution, packages, checkpoint.artifacts)
+    checkpoint.remove()
 
 
 @task
+@native_only
 def major(level=None):
     """
     Release a major version for this package. Increase the first part of the
@@ -124,9 +379,12 @@ def major(level=None):
 
     # Get the last released version from changelog
     last_released_version = helpers.get_last_version()
+    if _resume(last_released_version):
+        return
     puts(cyan('Last released version is %s.' % last_released_version))
 
     # Make a new version
+    from semantic_version import Version
     new_version = Version(str(last_released_version))
 
     if level:
@@ -144,6 +402,7 @@ def major(level=None):
 
 
 @task
+@native_only
 def minor(level=None):
     """
     Release a minor version for this package. Increase the middle part of the
@@ -159,9 +418,12 @@ def minor(level=None):
 
     # Get the last released version from changelog
     last_released_version = helpers.get_last_version()
+    if _resume(last_released_version):
+        return
     puts(cyan('Last released version is %s.' % last_released_version))
 
     # Make a new version
+    from semantic_version import Version
     new_version = Version(str(last_released_version))
 
     if level:
@@ -178,6 +440,7 @@ def minor(level=None):
 
 
 @task
+@native_only
 def patch(level=None):
     """
     Release a patch for this package. Increase the last part of the version
@@ -193,9 +456,12 @@ def patch(level=None):
 
     # Get the last released version from changelog
     last_released_version = helpers.get_last_version()
+    if _resume(last_released_version):
+        return
     puts(cyan('Last released version is %s.' % last_released_version))
 
     # Make a new version
+    from semantic_version import Version
     new_version = Version(str(last_released_version))
 
     if level:
@@ -208,3 +474,238 @@ def patch(level=None):
 
     # Call new to init the full process
     execute(new, str(new_version))
+
+
+# Version parts a batch release can bump.
+BUMP_LEVELS = ('major', 'minor', 'patch')
+
+# Log of the batch steps run in a repository, kept out of the working copy.
+BATCH_LOG = '.git/zfabric-batch.log'
+
+
+def _bump(last_version, level):
+    """
+    Get the version following ``last_version`` at ``level``.
+
+    :param level: major, minor or patch.
+    :type level: str
+    :rtype: Version
+    """
+    from semantic_version import Version
+
+    new_version = Version(str(last_version))
+    if level == 'major':
+        new_version.major += 1
+        new_version.minor = 0
+        new_version.patch = 0
+    elif level == 'minor':
+        new_version.minor += 1
+        new_version.patch = 0
+    else:
+        new_version.patch += 1
+    new_version.build = None
+    return new_version
+
+
+def _in_repository(job):
+    """
+    Run a batch step in a repository, in a pool process.
+
+    The output goes to :data:`BATCH_LOG` of the repository, and the outcome
+    is turned into a status so one failing repository does not stop the
+    others.
+
+    :param job: the step function, repository path and step arguments.
+    :type job: tuple
+    :return: the repository, status, error message, duration and result.
+    :rtype: dict
+    """
+    func, repository, args = job
+    start = time.time()
+    try:
+        os.chdir(repository)
+        git.invalidate()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        with open(BATCH_LOG, 'a') as log:
+            os.dup2(log.fileno(), 1)
+            os.dup2(log.fileno(), 2)
+        result = func(*args)
+        status, error = 'ok', None
+    except SystemExit:
+        result, status, error = None, 'failed', 'aborted, see {}'.format(
+            BATCH_LOG)
+    except Exception as e:
+        result, status, error = None, 'failed', str(e) or \
+            e.__class__.__name__
+    return {
+        'repository': repository,
+        'status': status,
+        'error': error,
+        'duration': time.time() - start,
+        'result': result,
+    }
+
+
+def _batch_prepare(level):
+    """
+    Bump, tag and build the package of the current directory.
+
+    :return: version, distribution, packages and built files.
+    :rtype: dict
+    """
+    from .build import build
+    import util
+
+    if helpers.package_has_upstream():
+        abort('This package has an upstream source, it cannot be released !')
+
+    context = preflight()
+    if not context.has_tag():
+        abort('No version yet, use package.release.new() first !')
+
+    version = str(_bump(context.last_version, level))
+    if context.has_tag(version):
+        abort('Error: version \'%s\' already exist !' % version)
+
+    local('make distclean')
+    helpers.new_version(version)
+    helpers.tag()
+    build()
+
+    build_dir = os.path.abspath(helpers.get_build_dir(context.distribution))
+    return {
+        'version': version,
+        'distribution': context.distribution,
+        'packages': context.packages,
+        'artifacts': util.local_artifacts(build_dir, context.packages),
+    }
+
+
+def _batch_push():
+    """Push the repository of the current directory."""
+    git.push()
+
+
+def _batch_run(func, jobs, pool_size):
+    """
+    Run ``func`` in every repository of ``jobs`` (path and arguments), at
+    most ``pool_size`` at once.
+
+    :return: outcome of every repository, see :func:`_in_repository`.
+    :rtype: list(dict)
+    """
+    # A fresh process per repository: no cache or state leaks between them
+    pool = multiprocessing.Pool(pool_size, maxtasksperchild=1)
+    try:
+        return pool.map(_in_repository, [
+            (func, repository, args) for repository, args in jobs])
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _batch_report(step, outcomes):
+    """Show the status of a step in every repository."""
+    puts('{}:'.format(step))
+    for outcome in outcomes:
+        if outcome['status'] == 'ok':
+            line = '  {0}: ok ({1:.1f}s)'.format(outcome['repository'],
+                                                 outcome['duration'])
+            if outcome['result']:
+                line += ' v{version} for {distribution}'.format(
+                    **outcome['result'])
+            puts(green(line))
+        else:
+            puts(red('  {0}: {1} ({2:.1f}s) {3}'.format(
+                outcome['repository'], outcome['status'],
+                outcome['duration'], outcome['error'])))
+
+
+@task
+def batch(repositories, level='patch', pool_size=None, policy='all'):
+    """
+    Release a new version of several packages at once.
+
+    Each repository (paths separated by ``;``) gets its ``level`` part of the
+    version bumped, then is tagged and built, in parallel in at most
+    ``pool_size`` processes (default to the number of CPUs). Logs are written
+    in ``.git/zfabric-batch.log`` of each repository. After a single
+    confirmation, the repositories are pushed and their packages uploaded
+    with one publication per distribution, eg.
+    ``fab package.release.batch:repositories="../foo;../bar",level=minor``.
+
+    :param repositories: paths of the packaging repositories.
+    :type repositories: str
+    :param level: major, minor or patch.
+    :type level: str
+    :param pool_size: maximum number of repositories handled at once.
+    :type pool_size: int
+    :param policy: upload policy, see :func:`util.upload`.
+    :type policy: str
+    """
+    import util
+
+    if level not in BUMP_LEVELS:
+        abort('Unknown level \'{0}\', use one of: {1}.'.format(
+            level, ', '.join(BUMP_LEVELS)))
+
+    paths = [os.path.abspath(os.path.expanduser(path))
+             for path in repositories.split(';') if path]
+    pool_size = int(pool_size) if pool_size else None
+
+    puts(green('Preparing {0} release of {1} package(s)...'.format(
+        level, len(paths)), bold=True))
+    with trace.stage('batch.prepare'):
+        prepared = _batch_run(_batch_prepare,
+                              [(path, (level,)) for path in paths], pool_size)
+    _batch_report('Release', prepared)
+
+    ready = [outcome for outcome in prepared if outcome['status'] == 'ok']
+    if not ready:
+        abort('No package could be released !')
+
+    by_distribution = {}
+    for outcome in ready:
+        release = outcome['result']
+        packages, artifacts = by_distribution.setdefault(
+            release['distribution'], (set(), {}))
+        packages.update(release['packages'])
+        artifacts.update(release['artifacts'])
+
+    puts('\n\nYou are about to push {0} package(s) of {1} repository(ies) '
+         'to: {2}'.format(
+             sum(len(packages) for packages, _ in by_distribution.values()),
+             len(ready), ', '.join(sorted(by_distribution))))
+    if len(ready) < len(prepared):
+        puts(yellow('{} repository(ies) failed and will be skipped.'.format(
+            len(prepared) - len(ready))))
+
+    answer = confirm(red(
+        'Last chance before pushing centrally, are you ready ?',
+        bold=True), default=False)
+    if not answer or answer == 'no':
+        puts(yellow('Deleting local tags.'))
+        for outcome in ready:
+            with lcd(outcome['repository']):
+                git.delete_tag(outcome['result']['version'])
+        abort('Aborting. Pushing is cancelled.')
+
+    with trace.stage('batch.push'):
+        pushed = _batch_run(_batch_push,
+                            [(outcome['repository'], ()) for outcome in ready],
+                            pool_size)
+    _batch_report('Push', pushed)
+    failed = [outcome['repository'] for outcome in pushed
+              if outcome['status'] != 'ok']
+    if failed:
+        abort('Pushing failed for {} repository(ies), nothing was '
+              'uploaded !'.format(len(failed)))
+
+    with trace.stage('batch.upload'):
+        for distribution, (packages, artifacts) in sorted(
+                by_distribution.items()):
+            puts(green('Publishing {0} file(s) for {1}...'.format(
+                len(artifacts), distribution)))
+            util.upload_artifacts(distribution, sorted(packages), artifacts,
+                                  policy=policy)
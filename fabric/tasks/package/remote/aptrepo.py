@@ -0,0 +1,843 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) Canux CHENG <canuxcheng@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Maintain a central APT repository.
+
+This script runs on the central host: it is shipped and executed by
+:mod:`fabric.tasks.package.util`. Keep it standalone (standard library only)
+and compatible with the Python 2 and 3 versions found on the servers.
+
+Usage::
+
+    python aptrepo.py index [--full] <repository_dir>
+    python aptrepo.py publish [--full] [--staging DIR] [--pool DIR]
+                              [--queue DIR] [--keep N] [--package NAME]...
+                              [--file NAME[=SHA256]]... [--key KEY]
+                              <repository_dir>
+
+``publish`` runs every step of a publication (prune, move, collect, index,
+release, sign) in one go and prints their status as JSON on its last output
+line.
+
+With a queue, concurrent publications in the same repository are serialized
+by a lock and coalesced: the first one to get the lock publishes all the
+pending ones with a single index, release and signature.
+
+With a pool, packages are stored once in ``<pool>/<xx>/<sha256>`` and the
+repositories of the distributions hold hardlinks to them, blobs nothing
+links to anymore are removed by the collect step.
+"""
+
+import argparse
+import errno
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from functools import cmp_to_key
+from contextlib import contextmanager
+
+# Per repository cache of the dpkg-scanpackages record of every package.
+INDEX_CACHE = '.Packages.cache'
+INDEX_CACHE_VERSION = 1
+
+# Index files published next to Packages.
+COMPRESSED_INDEXES = ('Packages.gz', 'Packages.xz')
+
+# Release hash fields (as written by apt-ftparchive) and hashlib names,
+# index files are also published under by-hash/<field>/<digest>.
+BY_HASH = (
+    ('MD5Sum', 'md5'),
+    ('SHA1', 'sha1'),
+    ('SHA256', 'sha256'),
+    ('SHA512', 'sha512'),
+)
+
+# Generations of indexes kept in by-hash for clients in the middle of an
+# update.
+BY_HASH_GENERATIONS = 3
+
+
+# Steps of a publication, in order.
+PUBLISH_STEPS = ('prune', 'move', 'collect', 'index', 'release', 'sign')
+
+# Files of a publish queue: its lock, the pending requests and their
+# outcome, see publish_queued().
+QUEUE_LOCK = '.lock'
+QUEUE_REQUEST = '.request'
+QUEUE_DONE = '.done'
+
+# Lock of the pool, shared while linking blobs, exclusive while collecting.
+POOL_LOCK = '.lock'
+
+# Seconds after which what is left in a staging directory by failed or
+# aborted uploads is removed, see clean_staging().
+STAGING_TTL = 24 * 3600
+
+
+class StepError(Exception):
+    """Raised when a step of a publication fails."""
+
+
+def call(args, cwd, stdout=None):
+    """
+    Run a command, its error output is only shown if it fails.
+
+    :return: the standard output, unless ``stdout`` is given.
+    :rtype: str
+    """
+    process = subprocess.Popen(args, cwd=cwd, stderr=subprocess.PIPE,
+                               stdout=stdout or subprocess.PIPE)
+    output, errors = process.communicate()
+    if isinstance(errors, bytes):
+        errors = errors.decode('utf-8', 'replace')
+    if process.returncode:
+        raise StepError('{0} failed ({1}): {2}'.format(
+            args[0], process.returncode, errors.strip()))
+    if isinstance(output, bytes):
+        output = output.decode('utf-8')
+    return output
+
+
+def find_debs(root):
+    """
+    List the ``.deb`` files under ``root`` like ``dpkg-scanpackages`` does:
+    symlinks followed, paths relative to ``root`` and prefixed by ``./``, in
+    directory order.
+
+    :rtype: list(str)
+    """
+    debs = []
+    directories = ['.']
+    seen = set()
+
+    while directories:
+        directory = directories.pop(0)
+        real = os.path.realpath(os.path.join(root, directory))
+        if real in seen:
+            continue
+        seen.add(real)
+
+        subdirectories = []
+        for name in os.listdir(os.path.join(root, directory)):
+            path = os.path.join(directory, name)
+            if os.path.isdir(os.path.join(root, path)):
+                subdirectories.append(path)
+            elif name.endswith('.deb'):
+                debs.append(path)
+        directories[0:0] = subdirectories
+
+    return debs
+
+
+def split_records(output):
+    """
+    Split a ``Packages`` content in records, each ending with a newline.
+
+    :rtype: list(str)
+    """
+    return [record + '\n' for record in output.split('\n\n') if record]
+
+
+def record_field(record, field):
+    """Get the value of a single line ``field`` in a ``Packages`` record."""
+    prefix = field + ': '
+    for line in record.splitlines():
+        if line.startswith(prefix):
+            return line[len(prefix):]
+    return None
+
+
+def scan(root, paths=None):
+    """
+    Run ``dpkg-scanpackages -m`` on ``paths`` (all the packages if None).
+
+    Selected packages are symlinked in a temporary tree with the same
+    layout so ``Filename`` fields are the ones a full scan would give.
+
+    :return: the records indexed by ``Filename``.
+    :rtype: dict
+    """
+    if paths is None:
+        scan_dir, tmp_dir = root, None
+    else:
+        scan_dir = tmp_dir = tempfile.mkdtemp(prefix='aptrepo-')
+
+    try:
+        if tmp_dir:
+            for path in paths:
+                link = os.path.join(tmp_dir, path)
+                if not os.path.isdir(os.path.dirname(link)):
+                    os.makedirs(os.path.dirname(link))
+                os.symlink(os.path.abspath(os.path.join(root, path)), link)
+
+        output = call(['dpkg-scanpackages', '-m', '.'], scan_dir)
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+
+    return dict((record_field(record, 'Filename'), record)
+                for record in split_records(output))
+
+
+def load_cache(root):
+    """Load the index cache of the repository, empty if missing or stale."""
+    try:
+        with open(os.path.join(root, INDEX_CACHE)) as cache_file:
+            cache = json.load(cache_file)
+        if cache.get('version') == INDEX_CACHE_VERSION:
+            return cache['entries']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def write_atomic(path, content):
+    """Replace the file at ``path`` with ``content`` in one rename."""
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as tmp_file:
+        tmp_file.write(content.encode('utf-8'))
+    os.rename(tmp_path, path)
+
+
+def compress(root):
+    """Write the compressed versions of ``Packages``."""
+    packages = os.path.join(root, 'Packages')
+
+    tmp_path = '{0}.gz.{1}.tmp'.format(packages, os.getpid())
+    with open(packages, 'rb') as source:
+        # No name nor timestamp in the header, same content gives same file
+        with open(tmp_path, 'wb') as raw:
+            compressed = gzip.GzipFile('', 'wb', 9, raw, 0)
+            shutil.copyfileobj(source, compressed)
+            compressed.close()
+    os.rename(tmp_path, packages + '.gz')
+
+    tmp_path = '{0}.xz.{1}.tmp'.format(packages, os.getpid())
+    with open(packages, 'rb') as source:
+        with open(tmp_path, 'wb') as compressed:
+            subprocess.check_call(['xz', '-9', '-c'], stdin=source,
+                                  stdout=compressed)
+    os.rename(tmp_path, packages + '.xz')
+
+
+def link_by_hash(root):
+    """
+    Hardlink the index files in ``by-hash/<field>/<digest>`` and drop the
+    links older than :data:`BY_HASH_GENERATIONS` generations.
+    """
+    indexes = ['Packages'] + list(COMPRESSED_INDEXES)
+
+    for field, algorithm in BY_HASH:
+        directory = os.path.join(root, 'by-hash', field)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        current = set()
+        for name in indexes:
+            path = os.path.join(root, name)
+            digest = hashlib.new(algorithm)
+            with open(path, 'rb') as index_file:
+                for block in iter(lambda: index_file.read(1 << 20), b''):
+                    digest.update(block)
+            link = os.path.join(directory, digest.hexdigest())
+            current.add(digest.hexdigest())
+            if not os.path.exists(link):
+                os.link(path, link)
+
+        links = sorted(os.listdir(directory), reverse=True,
+                       key=lambda name: os.stat(
+                           os.path.join(directory, name)).st_mtime)
+        kept = len(indexes) * BY_HASH_GENERATIONS
+        for name in links[kept:]:
+            if name not in current:
+                os.unlink(os.path.join(directory, name))
+
+
+def index(root, full=False):
+    """
+    Write the ``Packages`` file of the repository, byte-identical to
+    ``dpkg-scanpackages -m .``, its compressed versions and the by-hash
+    links.
+
+    Records are cached per file with its size and modification time, so only
+    new or changed packages are scanned. ``full`` ignores the cache and scans
+    the whole repository.
+
+    :return: number of packages indexed, scanned and dropped.
+    :rtype: dict
+    """
+    cache = {} if full else load_cache(root)
+    debs = find_debs(root)
+
+    entries = {}
+    changed = []
+    for path in debs:
+        stat = os.stat(os.path.join(root, path))
+        entry = cache.get(path)
+        if entry and entry['size'] == stat.st_size and \
+                entry['mtime'] == stat.st_mtime:
+            entries[path] = entry
+        else:
+            entries[path] = {'size': stat.st_size, 'mtime': stat.st_mtime}
+            changed.append(path)
+
+    if changed:
+        records = scan(root, None if full else changed)
+        for path in changed:
+            record = records.get(path)
+            if record is None:
+                # dpkg-scanpackages skipped it (broken package), so do we
+                del entries[path]
+                continue
+            entries[path].update({
+                'package': record_field(record, 'Package'),
+                'version': record_field(record, 'Version'),
+                'record': record,
+            })
+
+    # Same order as dpkg-scanpackages: package name then version, compared
+    # as strings, ties kept in directory order.
+    ordered = sorted((entries[path] for path in debs if path in entries),
+                     key=lambda entry: (entry['package'], entry['version']))
+    content = ''.join(entry['record'] + '\n' for entry in ordered)
+
+    # Leave unchanged indexes alone so clients can skip them
+    packages = os.path.join(root, 'Packages')
+    try:
+        with open(packages, 'rb') as current:
+            unchanged = current.read() == content.encode('utf-8')
+    except (IOError, OSError):
+        unchanged = False
+    published = all(os.path.exists(os.path.join(root, name))
+                    for name in COMPRESSED_INDEXES)
+
+    if not unchanged or not published:
+        write_atomic(packages, content)
+        compress(root)
+        link_by_hash(root)
+
+    write_atomic(os.path.join(root, INDEX_CACHE), json.dumps({
+        'version': INDEX_CACHE_VERSION,
+        'entries': entries,
+    }))
+
+    return {
+        'indexed': len(ordered),
+        'scanned': len(changed),
+        'dropped': len(set(cache) - set(entries)),
+    }
+
+
+def _order(char):
+    """Weight of a non-digit character in a version, like dpkg."""
+    if char.isalpha():
+        return ord(char)
+    if char == '~':
+        return -1
+    return ord(char) + 256
+
+
+def _compare_part(a, b):
+    """Compare upstream versions or revisions, like dpkg's verrevcmp()."""
+    i = j = 0
+    while i < len(a) or j < len(b):
+        # Non-digit prefixes, the end of a string and digits weigh 0
+        while (i < len(a) and not a[i].isdigit()) or \
+                (j < len(b) and not b[j].isdigit()):
+            a_order = _order(a[i]) if i < len(a) and not a[i].isdigit() else 0
+            b_order = _order(b[j]) if j < len(b) and not b[j].isdigit() else 0
+            if a_order != b_order:
+                return a_order - b_order
+            i += 1
+            j += 1
+
+        # Numbers
+        a_start, b_start = i, j
+        while i < len(a) and a[i].isdigit():
+            i += 1
+        while j < len(b) and b[j].isdigit():
+            j += 1
+        a_number, b_number = int(a[a_start:i] or 0), int(b[b_start:j] or 0)
+        if a_number != b_number:
+            return a_number - b_number
+    return 0
+
+
+def compare_versions(a, b):
+    """
+    Compare two Debian versions like ``dpkg --compare-versions``.
+
+    :return: negative, 0 or positive if ``a`` is lower, equal or greater.
+    :rtype: int
+    """
+    def parse(version):
+        epoch = 0
+        if ':' in version:
+            epoch, version = version.split(':', 1)
+            epoch = int(epoch)
+        upstream, _, revision = version.rpartition('-')
+        return (epoch, upstream, revision) if upstream else \
+            (epoch, version, '')
+
+    a_epoch, a_upstream, a_revision = parse(a)
+    b_epoch, b_upstream, b_revision = parse(b)
+    return (a_epoch - b_epoch or
+            _compare_part(a_upstream, b_upstream) or
+            _compare_part(a_revision, b_revision))
+
+
+def prune(root, packages, keep):
+    """
+    Delete the old versions of ``packages`` so at most ``keep`` of each
+    remain (the highest ones) before the new ones are moved in.
+
+    Versions are taken from the index cache, or from the file names (which
+    lack the epoch) for the packages not indexed yet.
+
+    :return: the deleted file names.
+    :rtype: list(str)
+    """
+    cache = load_cache(root)
+    by_package = defaultdict(list)
+    for name in os.listdir(root):
+        if name.endswith('.deb') and name.count('_') >= 2:
+            package, version = name.split('_')[:2]
+            entry = cache.get(os.path.join('.', name))
+            if entry and entry.get('version'):
+                version = entry['version']
+            by_package[package].append((version, name))
+
+    deleted = []
+    for package in packages:
+        newest = sorted(by_package[package], reverse=True,
+                        key=cmp_to_key(lambda a, b: compare_versions(
+                            a[0], b[0])))
+        for _, name in newest[keep:]:
+            os.unlink(os.path.join(root, name))
+            deleted.append(name)
+    return deleted
+
+
+def makedirs(path):
+    """Create ``path``, other processes may do it at the same time."""
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+@contextmanager
+def locked(path, operation=fcntl.LOCK_EX):
+    """Hold a lock on the file ``path``, created if needed."""
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def pool_path(pool, checksum):
+    """Path of the blob of ``checksum`` in the pool."""
+    return os.path.join(pool, checksum[:2], checksum)
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as blob:
+        for block in iter(lambda: blob.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def link(source, target):
+    """Make ``target`` a hardlink of ``source``, replacing it in one rename."""
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return
+    tmp_path = '{0}.{1}.tmp'.format(target, os.getpid())
+    os.link(source, tmp_path)
+    os.rename(tmp_path, target)
+
+
+def move(root, staging, files, pool=None):
+    """
+    Move the staged ``files`` (name and sha256) in the repository. Only
+    these files are taken from the staging directory, a concurrent upload
+    may be staging others in it.
+
+    With a ``pool``, a staged file becomes the blob of its checksum (after
+    checking it) unless the pool has it already, and the repository gets a
+    hardlink to the blob. Files not staged (not sent again) are linked from
+    the pool when it has them, else left as they are.
+
+    :return: the file names moved or linked in the repository.
+    :rtype: list(str)
+    """
+    staged = staging and os.path.isdir(staging)
+
+    if not pool:
+        return _move(root, staging if staged else None, files)
+
+    makedirs(pool)
+    with locked(os.path.join(pool, POOL_LOCK), fcntl.LOCK_SH):
+        return _move(root, staging if staged else None, files, pool)
+
+
+def _move(root, staging, files, pool=None):
+    moved = []
+    for name, checksum in files:
+        path = os.path.join(staging, name) if staging else None
+        target = os.path.join(root, name)
+        if path and not os.path.exists(path):
+            path = None
+
+        if not pool or not checksum:
+            if path:
+                os.rename(path, target)
+                moved.append(name)
+            continue
+
+        blob = pool_path(pool, checksum)
+        if os.path.exists(blob):
+            link(blob, target)
+            if path:
+                os.remove(path)
+            moved.append(name)
+        elif path:
+            if file_checksum(path) != checksum:
+                raise StepError('{} does not match its checksum.'.format(
+                    name))
+            makedirs(os.path.dirname(blob))
+            # Linked from the repository first, so a concurrent collect
+            # never sees the blob unused
+            link(path, target)
+            os.rename(path, blob)
+            moved.append(name)
+    return moved
+
+
+def collect(pool):
+    """
+    Remove the blobs of the pool no repository links to anymore.
+
+    :return: number of blobs removed and bytes freed.
+    :rtype: dict
+    """
+    removed, freed = 0, 0
+    if pool and os.path.isdir(pool):
+        with locked(os.path.join(pool, POOL_LOCK)):
+            for directory, _, names in os.walk(pool):
+                for name in names:
+                    path = os.path.join(directory, name)
+                    stat = os.lstat(path)
+                    if stat.st_nlink == 1 and name != POOL_LOCK:
+                        os.unlink(path)
+                        removed += 1
+                        freed += stat.st_size
+    return {'removed': removed, 'freed': freed}
+
+
+def clean_staging(staging, keep=(), ttl=None):
+    """
+    Remove the files (and temporary directories) left in the ``staging``
+    directory by failed or aborted uploads: the ones not changed for ``ttl``
+    seconds (default to :data:`STAGING_TTL`), except ``keep``. Uploads in
+    progress change their files, and the staged files found again by an
+    upload are touched.
+
+    :return: the names removed.
+    :rtype: list(str)
+    """
+    removed = []
+    if not staging or not os.path.isdir(staging):
+        return removed
+
+    cutoff = time.time() - (STAGING_TTL if ttl is None else ttl)
+    for name in os.listdir(staging):
+        path = os.path.join(staging, name)
+        try:
+            stat = os.lstat(path)
+        except OSError:
+            continue
+        if name in keep or stat.st_ctime >= cutoff:
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+        removed.append(name)
+    return removed
+
+
+def release(root):
+    """Write the ``Release`` file with apt-ftparchive."""
+    tmp_path = os.path.join(root, '.Release.{}.tmp'.format(os.getpid()))
+    try:
+        with open(tmp_path, 'wb') as tmp_file:
+            call(['apt-ftparchive',
+                  '-o', 'APT::FTPArchive::Release::Acquire-By-Hash=yes',
+                  'release', '.'], root, stdout=tmp_file)
+        os.rename(tmp_path, os.path.join(root, 'Release'))
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def sign(root, key):
+    """Sign ``Release`` in ``Release.gpg`` and ``InRelease``."""
+    call(['gpg', '-u', key, '--yes', '--output', 'Release.gpg', '-ba',
+          'Release'], root)
+    call(['gpg', '-u', key, '--yes', '--output', 'InRelease', '--clearsign',
+          'Release'], root)
+
+
+def run_step(name, action):
+    """
+    Run a step of a publication.
+
+    :return: name, status (ok or failed), duration and result or error.
+    :rtype: dict
+    """
+    step = {'step': name, 'status': 'ok', 'duration': 0.0}
+    start = time.time()
+    try:
+        step['result'] = action()
+    except (StepError, EnvironmentError) as e:
+        step['status'], step['error'] = 'failed', str(e)
+    step['duration'] = time.time() - start
+    return step
+
+
+def skip_step(name):
+    """
+    Get the status of a step not run because a previous one failed.
+
+    :rtype: dict
+    """
+    return {'step': name, 'status': 'skipped', 'duration': 0.0}
+
+
+def publish(root, staging=None, packages=(), files=(), keep=4, key=None,
+            full=False, pool=None):
+    """
+    Publish the staged packages: run every step of :data:`PUBLISH_STEPS`,
+    stopping at the first failure. Running it again is harmless.
+
+    :return: name, status (ok, failed or skipped), duration and result or
+             error of each step.
+    :rtype: list(dict)
+    """
+    actions = {
+        'prune': lambda: prune(root, packages, keep),
+        'move': lambda: move(root, staging, files, pool),
+        'collect': lambda: collect(pool),
+        'index': lambda: index(root, full),
+        'release': lambda: release(root),
+        'sign': lambda: sign(root, key) if key else None,
+    }
+
+    steps = []
+    for name in PUBLISH_STEPS:
+        if steps and steps[-1]['status'] != 'ok':
+            steps.append(skip_step(name))
+        else:
+            steps.append(run_step(name, actions[name]))
+    return steps
+
+
+def publish_pending(root, queue):
+    """
+    Publish all the requests pending in ``queue`` at once: one prune of all
+    their packages, the move of the files of each one, then a single
+    collect (with the cleaning of their staging directories, see
+    :func:`clean_staging`), index, release and signature. The outcome of
+    each request is written next to it. Call it with the queue lock held.
+
+    :return: number of requests published.
+    :rtype: int
+    """
+    requests = []
+    for name in sorted(os.listdir(queue)):
+        if name.endswith(QUEUE_REQUEST):
+            with open(os.path.join(queue, name)) as request_file:
+                requests.append((name[:-len(QUEUE_REQUEST)],
+                                 json.load(request_file)))
+    if not requests:
+        return 0
+
+    packages = sorted(set(package for _, request in requests
+                          for package in request['packages']))
+    keep = max(request['keep'] for _, request in requests)
+    pool = next((request['pool'] for _, request in requests
+                 if request['pool']), None)
+    key = next((request['key'] for _, request in requests
+                if request['key']), None)
+    full = any(request['full'] for _, request in requests)
+
+    pruned = run_step('prune', lambda: prune(root, packages, keep))
+
+    moved = {}
+    for request_id, request in requests:
+        if pruned['status'] != 'ok':
+            moved[request_id] = skip_step('move')
+        else:
+            moved[request_id] = run_step('move', lambda request=request: move(
+                root, request['staging'],
+                [tuple(entry) for entry in request['files']],
+                request['pool']))
+
+    # Staged files of every request are kept, even if their move failed
+    staged = defaultdict(set)
+    for _, request in requests:
+        staged[request['staging']].update(
+            entry[0] for entry in request['files'])
+
+    shared = []
+    actions = {
+        'collect': lambda: dict(collect(pool), stale=sum(
+            len(clean_staging(staging, names))
+            for staging, names in staged.items())),
+        'index': lambda: index(root, full),
+        'release': lambda: release(root),
+        'sign': lambda: sign(root, key) if key else None,
+    }
+    for name in PUBLISH_STEPS[2:]:
+        if pruned['status'] != 'ok' or \
+                (shared and shared[-1]['status'] != 'ok'):
+            shared.append(skip_step(name))
+        else:
+            shared.append(run_step(name, actions[name]))
+
+    for request_id, _ in requests:
+        steps = [pruned, moved[request_id]]
+        if moved[request_id]['status'] == 'ok':
+            steps.extend(shared)
+        else:
+            steps.extend(skip_step(name) for name in PUBLISH_STEPS[2:])
+        write_atomic(os.path.join(queue, request_id + QUEUE_DONE),
+                     json.dumps({'steps': steps,
+                                 'coalesced': len(requests)}))
+        os.remove(os.path.join(queue, request_id + QUEUE_REQUEST))
+    return len(requests)
+
+
+def publish_queued(root, queue, staging=None, packages=(), files=(), keep=4,
+                   key=None, full=False, pool=None):
+    """
+    Publish through the ``queue`` of the repository: the request is written
+    in it, then whoever gets the queue lock first publishes every pending
+    request at once (see :func:`publish_pending`), the others find their
+    outcome already written when they get it.
+
+    :return: the steps (see :func:`publish`) and the number of requests
+             published together.
+    :rtype: dict
+    """
+    makedirs(queue)
+    request_id = '{0:.6f}-{1}'.format(time.time(), os.getpid())
+    write_atomic(os.path.join(queue, request_id + QUEUE_REQUEST), json.dumps({
+        'staging': staging,
+        'packages': list(packages),
+        'files': list(files),
+        'keep': keep,
+        'key': key,
+        'full': full,
+        'pool': pool,
+    }))
+
+    done = os.path.join(queue, request_id + QUEUE_DONE)
+    with locked(os.path.join(queue, QUEUE_LOCK)):
+        if not os.path.exists(done):
+            publish_pending(root, queue)
+
+    with open(done) as done_file:
+        outcome = json.load(done_file)
+    os.remove(done)
+    return outcome
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain a central APT '
+                                                 'repository.')
+    commands = parser.add_subparsers(dest='command')
+
+    index_parser = commands.add_parser(
+        'index', help='write the Packages files, scanning new packages only')
+    index_parser.add_argument('--full', action='store_true',
+                              help='scan every package again')
+    index_parser.add_argument('repository_dir')
+
+    publish_parser = commands.add_parser(
+        'publish', help='prune, move the staged packages in, index, write '
+                        'and sign the Release file')
+    publish_parser.add_argument('--full', action='store_true',
+                                help='scan every package again')
+    publish_parser.add_argument('--staging', help='staging directory')
+    publish_parser.add_argument('--pool', help='shared package pool')
+    publish_parser.add_argument('--queue', help='publish queue of the '
+                                                'repository')
+    publish_parser.add_argument('--keep', type=int, default=4,
+                                help='old versions kept of each package')
+    publish_parser.add_argument('--package', action='append', default=[],
+                                dest='packages', help='package to prune')
+    publish_parser.add_argument('--file', action='append', default=[],
+                                dest='files', metavar='NAME[=SHA256]',
+                                help='staged file to move')
+    publish_parser.add_argument('--key', help='gpg key signing the release')
+    publish_parser.add_argument('repository_dir')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'index':
+        result = index(args.repository_dir, args.full)
+        sys.stderr.write('Indexed {indexed} package(s), scanned {scanned}, '
+                         'dropped {dropped}.\n'.format(**result))
+
+    elif args.command == 'publish':
+        files = [(entry.partition('=')[0], entry.partition('=')[2] or None)
+                 for entry in args.files]
+        if args.queue:
+            outcome = publish_queued(
+                args.repository_dir, args.queue, args.staging, args.packages,
+                files, args.keep, args.key, args.full, args.pool)
+        else:
+            outcome = {'steps': publish(
+                args.repository_dir, args.staging, args.packages, files,
+                args.keep, args.key, args.full, args.pool)}
+        sys.stdout.write(json.dumps(outcome) + '\n')
+        if any(step['status'] == 'failed' for step in outcome['steps']):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
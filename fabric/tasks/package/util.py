@@ -21,59 +21,489 @@
 
 """Utility tasks."""
 
+import base64
+import glob
+import gzip
+import json
+import os
+import pipes
+import posixpath
+import tarfile
+import time
+from functools import wraps
+from StringIO import StringIO
 
-from fabric.api import env, task, roles, cd, run, put, puts, abort
-from fabric.colors import yellow, green
+from fabric.api import env, task, runs_once, settings, execute, hide, run, \
+    put, puts, abort
+from fabric.colors import yellow, green, red
 
-from fabric import helpers
+from fabric import helpers, state, trace
+
+# Scripts run on the remote hosts, see _run_remote_script().
+REMOTE_SCRIPTS_DIR = os.path.join(os.path.dirname(__file__), 'remote')
+
+# Central APT repositories, see servers 'central' role.
+CENTRAL_USER = 'aptcentral'
+REPOSITORY_DIR = '/var/www/packages/apt/{}'
+STAGING_DIR = '/var/www/packages/apt/.incoming/{}'
+
+# Packages shared by the distributions, stored once by sha256 and hardlinked
+# in the repositories, see aptrepo.py.
+POOL_DIR = '/var/www/packages/apt/.pool/sha256'
+
+# Publish queue of each repository, concurrent uploads to a distribution are
+# published together, see aptrepo.py.
+QUEUE_DIR = '/var/www/packages/apt/.queue/{}'
+
+# How to handle a failure on one central host, see upload().
+UPLOAD_POLICIES = ('all', 'best-effort')
+
+# How the packages are sent, see upload().
+TRANSFER_MODES = ('archive', 'sftp')
+
+# Manifest of the files of an upload archive, checked on the central host.
+ARCHIVE_MANIFEST = 'SHA256SUMS'
+
+# Number of old versions of a package kept in the repository.
+KEEP_OLD_VERSIONS = 4
+
+# GnuPG key signing the releases.
+SIGNING_KEY = 'Monitoring'
+
+_remote_payloads = {}
+
+
+def _run_remote_script(name, *args):
+    """
+    Run a script of :data:`REMOTE_SCRIPTS_DIR` on the current host.
+
+    The script is sent gzipped and base64 encoded within the command itself,
+    so it costs a single command round-trip and nothing is left on the host.
+
+    :param name: file name of the script (eg. aptrepo.py).
+    :type name: str
+    :return: the output of the script.
+    """
+    if name not in _remote_payloads:
+        buf = StringIO()
+        with open(os.path.join(REMOTE_SCRIPTS_DIR, name), 'rb') as script:
+            archive = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+            archive.write(script.read())
+            archive.close()
+        _remote_payloads[name] = base64.b64encode(buf.getvalue())
+
+    return run('echo {0} | base64 -d | gunzip | '
+               '"$(command -v python3 || command -v python)" - {1}'.format(
+                   _remote_payloads[name],
+                   ' '.join(pipes.quote(str(arg)) for arg in args)))
+
+
+class UploadError(Exception):
+    """Raised instead of aborting while uploading to one central host."""
+
+
+def _on_host(func):
+    """
+    Run ``func`` on the current host and turn its outcome into a status, so
+    one failing host does not stop the others.
+
+    :return: the status, error message, duration and what ``func``
+             returned.
+    :rtype: dict
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        result = None
+        try:
+            with settings(abort_exception=UploadError):
+                result = func(*args, **kwargs)
+            status, error = 'ok', None
+        except UploadError as e:
+            status, error = 'failed', str(e)
+            result = getattr(e, 'result', None)
+        except Exception as e:
+            status, error = 'failed', str(e) or e.__class__.__name__
+        return {
+            'status': status,
+            'error': error,
+            'duration': time.time() - start,
+            'result': result,
+        }
+    return wrapper
+
+
+def local_artifacts(build_dir, packages):
+    """
+    Find the built files of ``packages`` and compute their checksum, as
+    expected by :func:`upload_artifacts`.
+
+    :param build_dir: directory holding the built packages, see
+                      :func:`fabric.helpers.get_build_dir`.
+    :type build_dir: str
+    :param packages: binary package names.
+    :type packages: list(str)
+    :return: local path and sha256 of every file, by file name.
+    :rtype: dict
+    """
+    artifacts = {}
+    for package in packages:
+        for path in glob.glob('{0}/{1}_*.deb'.format(build_dir, package)):
+            artifacts[os.path.basename(path)] = (
+                path, helpers.file_checksum(path))
+    return artifacts
+
+
+def _pool_path(checksum):
+    """Path of a package in the pool of the central hosts."""
+    return posixpath.join(POOL_DIR, checksum[:2], checksum)
+
+
+@_on_host
+def _stage(distribution, artifacts, transfer='archive', compress=False):
+    """
+    Send the new packages to the staging directory of the current host.
+
+    Files already in the repository or in the staging directory with the
+    same sha256, or already in the pool (published for another
+    distribution), are not sent again, this is asked in one command. The
+    others are sent as one archive (see :func:`_send_archive`)
+    or one by one with SFTP, depending on ``transfer``.
+    """
+    if not artifacts:
+        # sha256sum would read its standard input without files
+        return
+
+    repository_dir = REPOSITORY_DIR.format(distribution)
+    staging_dir = STAGING_DIR.format(distribution)
+
+    candidates, staged = [], []
+    for name in sorted(artifacts):
+        candidates.append(posixpath.join(repository_dir, name))
+        staged.append(posixpath.join(staging_dir, name))
+        candidates.append(staged[-1])
+
+    blobs = [_pool_path(checksum) for _, checksum in artifacts.values()]
+
+    # Staged files found again are touched, so the cleaning of the staging
+    # directory does not take them for leftovers before they are published
+    with trace.stage('upload.checksums'), hide('stdout'):
+        output = run(
+            'mkdir -p {0}; touch -c -- {1} 2>/dev/null; '
+            'sha256sum -- {2} 2>/dev/null; ls -d -- {3} 2>/dev/null; '
+            'true'.format(
+                staging_dir,
+                ' '.join(pipes.quote(path) for path in staged),
+                ' '.join(pipes.quote(path) for path in candidates),
+                ' '.join(pipes.quote(path) for path in blobs)))
+
+    remote_checksums, pooled = {}, set()
+    for line in output.splitlines():
+        fields = line.strip().split(None, 1)
+        if len(fields) == 2:
+            remote_checksums[fields[1]] = fields[0]
+        elif fields:
+            pooled.add(posixpath.basename(fields[0]))
+
+    missing = dict(
+        (name, (path, checksum))
+        for name, (path, checksum) in artifacts.items()
+        if checksum not in pooled and checksum not in (
+            remote_checksums.get(posixpath.join(repository_dir, name)),
+            remote_checksums.get(posixpath.join(staging_dir, name))))
+
+    if missing and transfer == 'archive':
+        with trace.stage('upload.archive'):
+            _send_archive(staging_dir, missing, compress)
+    elif missing:
+        for name, (path, _) in sorted(missing.items()):
+            with trace.stage('upload.put'):
+                put(path, staging_dir)
+
+    puts('{0} package(s) sent, {1} already there.'.format(
+        len(missing), len(artifacts) - len(missing)))
+
+
+class _ChannelWriter(object):
+    """File-like object writing to an SSH channel, for tarfile."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.size = 0
+
+    def write(self, data):
+        self.channel.sendall(data)
+        self.size += len(data)
+
+
+def _send_archive(staging_dir, artifacts, compress=False):
+    """
+    Send files to the staging directory of the current host as a single tar
+    stream over one channel.
+
+    The archive is extracted in a temporary directory, the sha256 of every
+    file is checked against the manifest and only then are the files moved
+    to ``staging_dir``, so it never holds a partial upload.
+
+    :param staging_dir: remote staging directory.
+    :type staging_dir: str
+    :param artifacts: local path and sha256 of the files, by file name.
+    :type artifacts: dict
+    :param compress: gzip the stream (packages are already compressed).
+    :type compress: bool
+    """
+    command = (
+        'set -e; mkdir -p {0}; tmp=$(mktemp -d {0}/.upload.XXXXXX); '
+        'trap \'rm -rf "$tmp"\' EXIT; tar -x{1}f - -C "$tmp"; cd "$tmp"; '
+        'sha256sum -c --quiet {2}; rm {2}; mv -f -- * {0}/').format(
+            pipes.quote(staging_dir), 'z' if compress else '',
+            ARCHIVE_MANIFEST)
+    manifest = ''.join('{0}  {1}\n'.format(checksum, name)
+                       for name, (_, checksum) in sorted(artifacts.items()))
+
+    if state.output.running:
+        print('[{0}] put: {1} file(s) as one archive -> {2}'.format(
+            env.host_string, len(artifacts), staging_dir))
+
+    channel = state.default_channel()
+    # Fabric polls with a short timeout, sending must be able to wait
+    channel.settimeout(None)
+    channel.set_combine_stderr(True)
+    trace.count('remote_commands')
+    channel.exec_command(command)
+
+    writer = _ChannelWriter(channel)
+    archive = tarfile.open(fileobj=writer, mode='w|gz' if compress else 'w|',
+                           dereference=True)
+    info = tarfile.TarInfo(ARCHIVE_MANIFEST)
+    info.size = len(manifest)
+    info.mtime = time.time()
+    archive.addfile(info, StringIO(manifest))
+    for name, (path, _) in sorted(artifacts.items()):
+        archive.add(path, arcname=name)
+    archive.close()
+    trace.count('bytes_sent', writer.size)
+
+    channel.shutdown_write()
+    output = channel.makefile('rb').read()
+    status = channel.recv_exit_status()
+    channel.close()
+
+    if status != 0:
+        abort('Extracting the upload archive in {0} failed:\n{1}'.format(
+            staging_dir, output.strip()))
+
+
+@_on_host
+def _publish(distribution, packages, artifacts, full_scan=False):
+    """
+    Move the staged packages in the repository of the current host (as
+    hardlinks to the shared pool), prune old versions, update the indexes
+    (plain, gzip, xz and by-hash) and sign the release (Release.gpg and
+    InRelease).
+
+    All the steps are run by a single ``aptrepo.py publish`` command, which
+    can be run again safely. It goes through the publish queue of the
+    repository: concurrent uploads to the same distribution wait for each
+    other and are indexed and signed once for all.
+
+    :return: status, duration and result of every step.
+    :rtype: list(dict)
+    """
+    args = ['publish', '--staging', STAGING_DIR.format(distribution),
+            '--pool', POOL_DIR, '--queue', QUEUE_DIR.format(distribution),
+            '--keep', KEEP_OLD_VERSIONS, '--key', SIGNING_KEY]
+    for package in packages:
+        args.extend(['--package', package])
+    for name, (_, checksum) in sorted(artifacts.items()):
+        args.extend(['--file', '{0}={1}'.format(name, checksum)])
+    if full_scan:
+        args.append('--full')
+    args.append(REPOSITORY_DIR.format(distribution))
+
+    puts(green('Publishing packages in the central APT repository...'))
+    with trace.stage('publish.remote'), hide('stdout'), \
+            settings(warn_only=True):
+        output = _run_remote_script('aptrepo.py', *args)
+
+    try:
+        outcome = json.loads(output.splitlines()[-1])
+        steps = outcome['steps']
+    except (IndexError, ValueError, KeyError):
+        abort('Unexpected answer of the central host:\n{}'.format(output))
+
+    if outcome.get('coalesced', 1) > 1:
+        puts('Published together with {} other upload(s).'.format(
+            outcome['coalesced'] - 1))
+
+    for step in steps:
+        if step['status'] == 'failed':
+            error = UploadError('{0} failed: {1}'.format(step['step'],
+                                                         step['error']))
+            error.result = steps
+            raise error
+        elif step['step'] == 'prune' and step['result']:
+            puts(yellow('Deleted {} old release(s).'.format(
+                len(step['result']))))
+        elif step['step'] == 'collect':
+            if step['result']['removed']:
+                puts(yellow('Freed {removed} unused package(s) of the pool '
+                            '({freed} bytes).'.format(**step['result'])))
+            if step['result'].get('stale'):
+                puts(yellow('Removed {} file(s) left by failed uploads in '
+                            'the staging directory.'.format(
+                                step['result']['stale'])))
+        elif step['step'] == 'index':
+            puts('Indexed {indexed} package(s), scanned {scanned}, '
+                 'dropped {dropped}.'.format(**step['result']))
+    return steps
+
+
+def _report(step, results):
+    """Show the status of a step on every host."""
+    puts('{} on central hosts:'.format(step))
+    for host, result in sorted(results.items()):
+        if result['status'] == 'ok':
+            puts(green('  {0}: ok ({1:.1f}s)'.format(
+                host, result['duration'])))
+        else:
+            puts(red('  {0}: {1} ({2:.1f}s) {3}'.format(
+                host, result['status'], result['duration'],
+                result['error'] or '')))
 
 
 @task
-@roles('central')
-def upload(distribution=None):
+@runs_once
+def upload(distribution=None, full_scan=False, parallel=True, pool_size=None,
+           policy='all', transfer='archive', compress=False):
     """
     Upload Debian package to central APT repository. This will also register it
     so it is available by apt-get.
 
+    Packages are first sent to every central host, then published (moved in
+    the repository, indexed and signed). Both steps run on all the hosts at
+    the same time, at most ``pool_size`` at once. With the ``all`` policy
+    nothing is published unless every host got the packages; with
+    ``best-effort`` the hosts that got them are published anyway.
+
+    The packages missing on a host are sent as a single tar stream, checked
+    against their sha256 and moved in place on the host (``archive``
+    transfer, optionally gzipped with ``compress``), or one by one with SFTP
+    (``sftp`` transfer).
+
+    The ``Packages`` index is updated incrementally, only new packages are
+    scanned. Set ``full_scan`` to scan the whole repository again.
+
+    The hosts of the ``central`` role are updated, unless hosts or roles are
+    given on the command line (``-H``/``-R``): only those are updated then.
+    The task runs once whatever the number of hosts.
+
+    :param distribution: distribution to upload to (like precise, trusty...)
+    :type distribution: str
+    :param full_scan: scan all the packages of the repository.
+    :type full_scan: bool
+    :param parallel: upload to the central hosts concurrently.
+    :type parallel: bool
+    :param pool_size: maximum number of hosts handled at the same time.
+    :type pool_size: int
+    :param policy: ``all`` (all-or-nothing) or ``best-effort``.
+    :type policy: str
+    :param transfer: ``archive`` or ``sftp``.
+    :type transfer: str
+    :param compress: gzip the archive.
+    :type compress: bool
     :roles: central
+    :return: status of every host.
+    :rtype: dict
     """
-    supported_distributions = (
-        'precise',
-        'trusty',
-    )
-
     if not distribution:
         abort('Distribution is not known ! Cannot upload. Aborting.')
+
+    with trace.stage('upload.artifacts'):
+        packages = helpers.get_package_list()
+        build_dir = helpers.get_build_dir(distribution)
+        artifacts = local_artifacts(build_dir, packages)
+    if not artifacts:
+        abort('No package built in {0} for {1}: {2} ! Aborting.'.format(
+            build_dir, distribution, ', '.join(packages)))
+
+    return upload_artifacts(distribution, packages, artifacts, full_scan,
+                            parallel, pool_size, policy, transfer, compress)
+
+
+def upload_artifacts(distribution, packages, artifacts, full_scan=False,
+                     parallel=True, pool_size=None, policy='all',
+                     transfer='archive', compress=False):
+    """
+    Send and publish ``artifacts`` on the central hosts, see :func:`upload`.
+
+    Packages built in other working copies can be published together this
+    way, eg. by :func:`fabric.tasks.package.release.batch`.
+
+    :param distribution: distribution to upload to.
+    :type distribution: str
+    :param packages: names of the packages, their old versions are pruned.
+    :type packages: list(str)
+    :param artifacts: local path and sha256 of every file, by file name.
+    :type artifacts: dict
+    :return: status of every host.
+    :rtype: dict
+    """
+    if not distribution in helpers.SUPPORTED_DISTRIBUTIONS:
+        abort('The distribution {} is not supported ! Aborting.'.format(
+            distribution))
+
+    if policy not in UPLOAD_POLICIES:
+        abort('Unknown upload policy \'{0}\', use one of: {1}.'.format(
+            policy, ', '.join(UPLOAD_POLICIES)))
+
+    if transfer not in TRANSFER_MODES:
+        abort('Unknown transfer mode \'{0}\', use one of: {1}.'.format(
+            transfer, ', '.join(TRANSFER_MODES)))
+
+    if not artifacts:
+        abort('No package to upload for {0}: {1} ! Aborting.'.format(
+            distribution, ', '.join(packages)))
+
+    fan_out = dict(
+        user=CENTRAL_USER,
+        parallel=helpers.is_true(parallel),
+        pool_size=int(pool_size) if pool_size else env.pool_size)
+
+    # Hosts or roles given on the command line replace the central role.
+    if env.hosts or env.roles:
+        targets = dict(hosts=env.hosts, roles=env.roles)
     else:
-        if not distribution in supported_distributions:
-            abort('The distribution {} is not supported ! Aborting.'.format(
-                distribution))
-
-    env.user = 'aptcentral'
-    repository_dir = '/var/www/packages/apt/{}'.format(distribution)
-
-    # Check old versions and clean if necessary
-    for package in helpers.get_package_list():
-        # Do not delete old packages ! Keep history in case of...
-        with cd(repository_dir):
-            num_old_version = int(run('find . -name \'{0}_*_*.deb\' | \\'
-                                      'wc -l'.format(package)))
-
-            # Keep latest 5 old versions of a package
-            if num_old_version > 4:
-                puts(yellow('Deleting old release...'))
-                num_to_delete = num_old_version - 4
-                run('ls -t1 {0}_*_*.deb | \\'
-                    'tail -{1} | \\'
-                    'xargs rm -v'.format(package, num_to_delete))
-
-        # Upload new package(s)
-        puts(green('Uploading new package to central APT repository...'))
-        put('pkg-build/{}_*.deb'.format(package), repository_dir)
-
-    # Generate Release and sign it
-    puts(green('Signing release file for APT usage...'))
-    with cd(repository_dir):
-        run('dpkg-scanpackages -m . > Packages')
-        run('apt-ftparchive release . > Release')
-        run('gpg -u Monitoring --yes --output Release.gpg -ba Release')
+        targets = dict(roles=['central'])
+
+    # Upload new package(s)
+    puts(green('Uploading new package to central APT repository...'))
+    with trace.stage('upload.stage'), settings(**fan_out):
+        staged = execute(_stage, distribution, artifacts, transfer,
+                         helpers.is_true(compress), **targets)
+    _report('Upload', staged)
+
+    ready = [host for host, result in staged.items()
+             if result['status'] == 'ok']
+    if len(ready) < len(staged) and policy == 'all':
+        abort('Upload failed on {} host(s), nothing was published !'.format(
+            len(staged) - len(ready)))
+
+    if ready:
+        with trace.stage('upload.publish'), settings(**fan_out):
+            published = execute(_publish, distribution, packages, artifacts,
+                                helpers.is_true(full_scan), hosts=ready)
+        _report('Publish', published)
+    else:
+        published = {}
+
+    results = dict(staged)
+    results.update(published)
+    failed = [host for host, result in results.items()
+              if result['status'] != 'ok']
+    if failed and policy == 'all':
+        abort('Publishing failed on {} host(s) !'.format(len(failed)))
+    elif failed:
+        puts(red('Central host(s) not updated: {}'.format(', '.join(failed))))
+
+    return results
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Canux CHENG <canuxcheng@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Timing of the pipeline stages.
+
+Set ``ZFABRIC_TRACE`` to a directory to record, for every stage, its wall
+time, the number of local processes and remote commands it ran and the bytes
+it uploaded. When fab exits, ``zfabric-<time>-<pid>.json`` (summary per
+stage name) and ``zfabric-<time>-<pid>.trace.json`` (Chrome trace events,
+open it in chrome://tracing or Perfetto) are written in that directory.
+
+When the variable is not set, :func:`stage` returns a shared object doing
+nothing and no function is wrapped, so instrumented code costs nothing::
+
+    with trace.stage('git-buildpackage'):
+        local('git-buildpackage')
+
+Counters go to the innermost stage of the current thread. Work done in
+processes forked by parallel Fabric tasks is timed by the stage wrapping the
+``execute()`` call only.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+TRACE_DIR = os.environ.get('ZFABRIC_TRACE')
+
+
+class _NullStage(object):
+    """Stage used when tracing is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def count(self, counter, value=1):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Stage(object):
+    """A timed stage, use it through :func:`stage`."""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.duration = None
+        self.counters = {
+            'subprocesses': 0,
+            'remote_commands': 0,
+            'bytes_sent': 0,
+        }
+
+    def __enter__(self):
+        _stack().append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.time() - self.start
+        _stack().pop()
+        with _lock:
+            _events.append((self, threading.current_thread().ident,
+                            exc_type is None))
+        return False
+
+    def count(self, counter, value=1):
+        """
+        Add ``value`` to a counter of the stage.
+
+        :param counter: subprocesses, remote_commands or bytes_sent.
+        :type counter: str
+        """
+        self.counters[counter] += value
+
+
+_lock = threading.Lock()
+_local = threading.local()
+_events = []
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def stage(name):
+    """
+    Time a stage of the pipeline, use it as a context manager.
+
+    :param name: name of the stage, stages with the same name are summed in
+                 the summary.
+    :type name: str
+    """
+    if TRACE_DIR is None:
+        return _NULL_STAGE
+    return Stage(name)
+
+
+def count(counter, value=1):
+    """Add ``value`` to a counter of the innermost running stage."""
+    stack = _stack()
+    if stack:
+        stack[-1].count(counter, value)
+
+
+def summary():
+    """
+    Sum the recorded stages by name.
+
+    :rtype: dict
+    """
+    stages = OrderedDict()
+    for recorded, _, succeeded in sorted(_events, key=lambda e: e[0].start):
+        total = stages.setdefault(recorded.name, {
+            'calls': 0,
+            'failures': 0,
+            'wall_time': 0.0,
+            'subprocesses': 0,
+            'remote_commands': 0,
+            'bytes_sent': 0,
+        })
+        total['calls'] += 1
+        total['failures'] += 0 if succeeded else 1
+        total['wall_time'] += recorded.duration
+        for counter, value in recorded.counters.items():
+            total[counter] += value
+    return {'pid': os.getpid(), 'stages': stages}
+
+
+def trace_events():
+    """
+    Get the recorded stages as Chrome trace events.
+
+    :rtype: dict
+    """
+    events = []
+    for recorded, thread, succeeded in _events:
+        args = dict(recorded.counters)
+        args['succeeded'] = succeeded
+        events.append({
+            'name': recorded.name,
+            'cat': 'zfabric',
+            'ph': 'X',
+            'ts': int(recorded.start * 1e6),
+            'dur': int(recorded.duration * 1e6),
+            'pid': os.getpid(),
+            'tid': thread,
+            'args': args,
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write():
+    """Write the summary and the trace events in :data:`TRACE_DIR`."""
+    if not _events:
+        return
+    if not os.path.isdir(TRACE_DIR):
+        os.makedirs(TRACE_DIR)
+
+    prefix = os.path.join(TRACE_DIR, 'zfabric-{0}-{1}'.format(
+        time.strftime('%Y%m%d%H%M%S'), os.getpid()))
+    with open(prefix + '.json', 'w') as summary_file:
+        json.dump(summary(), summary_file, indent=2)
+    with open(prefix + '.trace.json', 'w') as trace_file:
+        json.dump(trace_events(), trace_file)
+
+
+def _install():
+    """Wrap the process, remote command and upload primitives."""
+    import subprocess
+    from fabric import operations, sftp
+
+    popen_init = subprocess.Popen.__init__
+    run_command = operations._run_command
+    sftp_put = sftp.SFTP.put
+
+    def counting_popen_init(self, *args, **kwargs):
+        count('subprocesses')
+        return popen_init(self, *args, **kwargs)
+
+    def counting_run_command(*args, **kwargs):
+        count('remote_commands')
+        return run_command(*args, **kwargs)
+
+    def counting_put(self, local_path, *args, **kwargs):
+        if isinstance(local_path, basestring):
+            count('bytes_sent', os.path.getsize(local_path))
+        else:
+            position = local_path.tell()
+            local_path.seek(0, os.SEEK_END)
+            count('bytes_sent', local_path.tell())
+            local_path.seek(position)
+        return sftp_put(self, local_path, *args, **kwargs)
+
+    subprocess.Popen.__init__ = counting_popen_init
+    operations._run_command = counting_run_command
+    sftp.SFTP.put = counting_put
+
+    atexit.register(write)
+
+
+if TRACE_DIR is not None:
+    _install()
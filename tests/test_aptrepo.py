@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Canux CHENG <canuxcheng@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Tests of the metadata published by aptrepo.py in a local repository.
+
+Packages are built with ``dpkg-deb``. The ``Release`` and signature tests
+need ``apt-ftparchive`` and ``gpg`` and are skipped without them.
+"""
+
+import gzip
+import hashlib
+import imp
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+APTREPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                       'fabric', 'tasks', 'package', 'remote', 'aptrepo.py')
+
+aptrepo = imp.load_source('aptrepo', APTREPO)
+
+CONTROL = """\
+Package: {name}
+Version: {version}
+Architecture: all
+Maintainer: Canux CHENG <canuxcheng@gmail.com>
+Description: test package {name}
+"""
+
+# The indexes listed in Release and by-hash.
+INDEXES = ('Packages',) + aptrepo.COMPRESSED_INDEXES
+
+
+def which(program):
+    """Find ``program`` on ``PATH``."""
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(path, program)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def digest(path, algorithm='sha256'):
+    with open(path, 'rb') as content:
+        return hashlib.new(algorithm, content.read()).hexdigest()
+
+
+def read_release(path):
+    """
+    Read a ``Release`` file.
+
+    :return: the single line fields, and the size and digest of each file
+             listed under each hash field.
+    :rtype: tuple(dict, dict)
+    """
+    fields, files = {}, {}
+    current = None
+    with open(path) as release:
+        for line in release.read().splitlines():
+            if line.startswith(' ') and current:
+                checksum, size, name = line.split()
+                files.setdefault(current, {})[name] = (int(size), checksum)
+            else:
+                current, _, value = line.partition(':')
+                if value.strip():
+                    fields[current] = value.strip()
+    return fields, files
+
+
+class RepositoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='aptrepo-test-')
+        self.root = os.path.join(self.workdir, 'repository')
+        os.makedirs(self.root)
+        for name, version in (('foo', '1.0'), ('foo', '1.1'),
+                              ('bar', '2.0')):
+            self.build_deb(name, version)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def build_deb(self, name, version):
+        """Build a package with dpkg-deb in the repository."""
+        tree = os.path.join(self.workdir, '{0}_{1}'.format(name, version))
+        os.makedirs(os.path.join(tree, 'DEBIAN'))
+        with open(os.path.join(tree, 'DEBIAN', 'control'), 'w') as control:
+            control.write(CONTROL.format(name=name, version=version))
+        with open(os.devnull, 'w') as devnull:
+            # No epoch in file names
+            subprocess.check_call(
+                ['dpkg-deb', '-Zgzip', '--build', tree, os.path.join(
+                    self.root, '{0}_{1}_all.deb'.format(
+                        name, version.split(':')[-1]))],
+                stdout=devnull)
+        shutil.rmtree(tree)
+
+    def read(self, name):
+        with open(os.path.join(self.root, name), 'rb') as content:
+            return content.read()
+
+    def test_packages(self):
+        result = aptrepo.index(self.root)
+        self.assertEqual(result['indexed'], 3)
+
+        with open(os.devnull, 'w') as devnull:
+            expected = subprocess.check_output(
+                ['dpkg-scanpackages', '-m', '.'], cwd=self.root,
+                stderr=devnull)
+        self.assertEqual(self.read('Packages'), expected)
+
+        # Only the new package is scanned, same result
+        self.build_deb('baz', '0.1')
+        result = aptrepo.index(self.root)
+        self.assertEqual((result['indexed'], result['scanned']), (4, 1))
+        with open(os.devnull, 'w') as devnull:
+            expected = subprocess.check_output(
+                ['dpkg-scanpackages', '-m', '.'], cwd=self.root,
+                stderr=devnull)
+        self.assertEqual(self.read('Packages'), expected)
+
+    def test_compressed(self):
+        aptrepo.index(self.root)
+        packages = self.read('Packages')
+
+        with gzip.open(os.path.join(self.root, 'Packages.gz')) as index:
+            self.assertEqual(index.read(), packages)
+        self.assertEqual(subprocess.check_output(
+            ['xz', '-dc', os.path.join(self.root, 'Packages.xz')]), packages)
+
+    def test_by_hash(self):
+        aptrepo.index(self.root)
+        # More generations than kept
+        for version in range(aptrepo.BY_HASH_GENERATIONS + 1):
+            self.build_deb('baz', '0.{}'.format(version))
+            aptrepo.index(self.root)
+
+        for field, algorithm in aptrepo.BY_HASH:
+            directory = os.path.join(self.root, 'by-hash', field)
+            names = os.listdir(directory)
+            for name in names:
+                self.assertEqual(digest(os.path.join(directory, name),
+                                        algorithm), name)
+            for index in INDEXES:
+                self.assertIn(digest(os.path.join(self.root, index),
+                                     algorithm), names)
+            self.assertEqual(len(names),
+                             len(INDEXES) * aptrepo.BY_HASH_GENERATIONS)
+
+    def test_prune(self):
+        for version in ('1.10', '1.10~rc1', '1.9'):
+            self.build_deb('foo', version)
+        # Linked from the pool: the time of its first upload
+        os.utime(os.path.join(self.root, 'foo_1.10_all.deb'), (0, 0))
+
+        self.assertEqual(sorted(aptrepo.prune(self.root, ['foo'], 2)), [
+            'foo_1.0_all.deb', 'foo_1.1_all.deb', 'foo_1.9_all.deb'])
+        self.assertEqual(aptrepo.prune(self.root, ['foo'], 2), [])
+
+    def test_prune_epoch(self):
+        self.build_deb('foo', '1:0.5')
+        # The epoch is only known once indexed
+        aptrepo.index(self.root)
+        self.assertEqual(sorted(aptrepo.prune(self.root, ['foo'], 1)), [
+            'foo_1.0_all.deb', 'foo_1.1_all.deb'])
+
+    def test_compare_versions(self):
+        ordered = ['1.0~rc1', '1.0', '1.0-1', '1.0-1ubuntu1', '1.0+b1',
+                   '1.0.1', '1.9', '1.10', '1:0.5']
+        for lower, higher in zip(ordered, ordered[1:]):
+            self.assertLess(aptrepo.compare_versions(lower, higher), 0)
+            self.assertGreater(aptrepo.compare_versions(higher, lower), 0)
+        self.assertEqual(aptrepo.compare_versions('1.00', '1.0'), 0)
+
+    def test_clean_staging(self):
+        staging = os.path.join(self.workdir, 'staging')
+        os.makedirs(os.path.join(staging, '.upload.x'))
+        for name in ('left_1.0_all.deb', 'pending_1.0_all.deb'):
+            open(os.path.join(staging, name), 'w').close()
+
+        self.assertEqual(aptrepo.clean_staging(staging), [])
+        self.assertEqual(sorted(aptrepo.clean_staging(
+            staging, ['pending_1.0_all.deb'], ttl=-1)),
+            ['.upload.x', 'left_1.0_all.deb'])
+        self.assertEqual(os.listdir(staging), ['pending_1.0_all.deb'])
+
+    def test_publish_queued(self):
+        staging = os.path.join(self.workdir, 'staging')
+        os.makedirs(staging)
+        shutil.move(os.path.join(self.root, 'bar_2.0_all.deb'), staging)
+        open(os.path.join(staging, 'left_1.0_all.deb'), 'w').close()
+        queue = os.path.join(self.workdir, 'queue')
+
+        ttl, aptrepo.STAGING_TTL = aptrepo.STAGING_TTL, -1
+        try:
+            outcome = aptrepo.publish_queued(
+                self.root, queue, staging, ['bar'],
+                [('bar_2.0_all.deb', None)])
+        finally:
+            aptrepo.STAGING_TTL = ttl
+
+        steps = dict((step['step'], step) for step in outcome['steps'])
+        self.assertEqual(outcome['coalesced'], 1)
+        self.assertEqual(steps['move']['result'], ['bar_2.0_all.deb'])
+        self.assertEqual(steps['collect']['result']['stale'], 1)
+        self.assertEqual(os.listdir(staging), [])
+        self.assertEqual(os.listdir(queue), [aptrepo.QUEUE_LOCK])
+
+    @unittest.skipUnless(which('apt-ftparchive'), 'needs apt-ftparchive')
+    def test_release(self):
+        steps = aptrepo.publish(self.root)
+        self.assertEqual([step['status'] for step in steps],
+                         ['ok'] * len(aptrepo.PUBLISH_STEPS))
+
+        fields, files = read_release(os.path.join(self.root, 'Release'))
+        self.assertEqual(fields.get('Acquire-By-Hash'), 'yes')
+        for field, algorithm in aptrepo.BY_HASH:
+            for index in INDEXES:
+                path = os.path.join(self.root, index)
+                self.assertEqual(files[field][index], (
+                    os.path.getsize(path), digest(path, algorithm)))
+        self.assertFalse(os.path.exists(os.path.join(self.root,
+                                                     'InRelease')))
+
+    @unittest.skipUnless(which('apt-ftparchive') and which('gpg'),
+                         'needs apt-ftparchive and gpg')
+    def test_signed_release(self):
+        home = os.path.join(self.workdir, 'gnupg')
+        os.makedirs(home, 0o700)
+        environ = dict(os.environ, GNUPGHOME=home)
+        key = 'aptrepo-test@example.com'
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                ['gpg', '--batch', '--passphrase', '', '--quick-gen-key',
+                 key, 'default', 'sign', 'never'],
+                env=environ, stdout=devnull, stderr=devnull)
+
+        os.environ['GNUPGHOME'] = home
+        try:
+            steps = aptrepo.publish(self.root, key=key)
+        finally:
+            del os.environ['GNUPGHOME']
+        self.assertEqual(steps[-1]['status'], 'ok')
+
+        with open(os.devnull, 'w') as devnull:
+            for args in (['InRelease'], ['Release.gpg', 'Release']):
+                subprocess.check_call(['gpg', '--verify'] + args,
+                                      cwd=self.root, env=environ,
+                                      stdout=devnull, stderr=devnull)
+        self.assertIn(self.read('Release'), self.read('InRelease'))
+
+
+if __name__ == '__main__':
+    unittest.main()
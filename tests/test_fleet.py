@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Canux CHENG <canuxcheng@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Tests of the fleet dispatcher, with a stand-in for the remote command.
+
+``fleet.py`` is loaded alone, with stand-ins of the Fabric modules it
+imports: the dispatcher does not use them.
+"""
+
+import imp
+import os
+import sys
+import time
+import unittest
+
+FLEET = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                     'fabric', 'tasks', 'fleet.py')
+
+# Names imported by fleet.py from each module.
+STUBS = {
+    'fabric': ('helpers', 'trace'),
+    'fabric.api': ('env', 'task', 'settings', 'hide', 'run', 'sudo', 'puts',
+                   'abort'),
+    'fabric.colors': ('yellow', 'green', 'red'),
+    'fabric.exceptions': ('CommandTimeout',),
+    'fabric.network': ('disconnect_all',),
+    'fabric.helpers': (),
+    'fabric.trace': (),
+}
+
+
+def _load_fleet():
+    """Load fleet.py with stand-ins of the Fabric modules."""
+    modules = dict((name, imp.new_module(name)) for name in STUBS)
+    modules['fabric'].__path__ = []
+    for name, attributes in STUBS.items():
+        for attribute in attributes:
+            # Decorators (task) must give back the function
+            setattr(modules[name], attribute,
+                    modules.get('{0}.{1}'.format(name, attribute),
+                                lambda *args, **kwargs: args and args[0]))
+    modules['fabric.exceptions'].CommandTimeout = type(
+        'CommandTimeout', (Exception,), {})
+    sys.modules.update(modules)
+    return imp.load_source('fleet', FLEET)
+
+
+fleet = _load_fleet()
+
+# Seconds a stand-in host takes.
+HOST_DURATION = 0.5
+
+HOSTS = ['host{}'.format(i) for i in range(6)]
+
+
+def _sleep_on_host(job):
+    """Stand-in for fleet._on_host, runs in the pool processes."""
+    start = time.time()
+    time.sleep(HOST_DURATION)
+    return {'host': job[0], 'start': start, 'end': time.time()}
+
+
+class DispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.on_host = fleet._on_host
+        fleet._on_host = _sleep_on_host
+
+    def tearDown(self):
+        fleet._on_host = self.on_host
+
+    def dispatch(self, **kwargs):
+        """Run on 6 hosts, 3 at once, sorted by start time."""
+        results = list(fleet.dispatch(HOSTS, 'true', 3, 10, **kwargs))
+        return sorted(results, key=lambda result: result['start'])
+
+    def test_window(self):
+        start = time.time()
+        results = self.dispatch()
+        self.assertEqual(sorted(result['host'] for result in results), HOSTS)
+        self.assertLess(time.time() - start, 3 * HOST_DURATION)
+
+    def test_batch(self):
+        start = time.time()
+        results = self.dispatch(batch=True)
+        self.assertEqual(sorted(result['host'] for result in results), HOSTS)
+        self.assertLess(time.time() - start, 3 * HOST_DURATION)
+
+        first, second = results[:3], results[3:]
+
+        # Each batch runs its hosts together...
+        for batch in (first, second):
+            self.assertLess(max(result['start'] for result in batch),
+                            min(result['end'] for result in batch))
+        # ...and the next one starts once it is done
+        self.assertGreaterEqual(min(result['start'] for result in second),
+                                max(result['end'] for result in first))
+
+    def test_stop(self):
+        checks = []
+
+        def stop():
+            # Stop once the first batch is started
+            checks.append(True)
+            return len(checks) > 3
+
+        results = self.dispatch(batch=True, stop=stop)
+        self.assertEqual(len(results), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()